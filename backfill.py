@@ -0,0 +1,241 @@
+import os
+import re
+import sys
+import json
+import logging
+import sqlite3
+import traceback
+import concurrent.futures
+import libs
+import blocks
+import ledger
+import metrics
+import migrate
+
+# Rows of a segment, in the column order of blocks.SQL_SAVEBLOCK, and its lease operations
+# in the order they were found, until the segment is merged
+SQL_STAGING = """
+    CREATE TABLE staged_blocks (height INTEGER PRIMARY KEY, generator, fees, txs, timestamp, tx16calls, blockid, reference);
+    CREATE TABLE staged_leaseops (seq INTEGER PRIMARY KEY, cancel INTEGER NOT NULL, params TEXT NOT NULL);
+"""
+
+# Files of stagingpath, .partial until the segment is complete
+STAGED_SEGMENT = re.compile(r'segment_\d{9}_\d{9}\.db(\.partial)?')
+
+class StagingTenant(blocks.Tenant):
+    """
+    The tenant of a segment worker. The leases of the earlier segments are not known yet,
+    so every lease cancellation is staged: the merge applies the ones of recorded leases,
+    as the cancellations of other leases do not match any waves_leases row.
+    """
+
+    def knows(self, lease_id):
+        return True
+
+def segments(startblock, endblock, size):
+    """
+    Splits [startblock, endblock] in segments aligned on multiples of size, so that
+    a resumed backfill finds the segments staged by the interrupted one.
+    """
+    for k in range((startblock - 1) // size, (endblock - 1) // size + 1):
+        yield max(startblock, k * size + 1), min(endblock, (k + 1) * size)
+
+def stagingpath(directory, startblock, endblock):
+    return os.path.join(directory, f"segment_{startblock:09d}_{endblock:09d}.db")
+
+def stagesegment(segment):
+    """
+    Worker of backfill: fetches the blocks of a segment and stages their rows, the file
+    only gets its final name once the whole segment is staged. Returns the number of
+    staged blocks. Runs in a worker process.
+    """
+
+    global logger
+
+    config, path, startblock, endblock, workers = segment
+    if logger is None:
+        logger = logging.getLogger('backfill')
+    blocks.config = config
+    blocks.logger = logger
+    # no cancel is looked up, the extended info only says whether the lease is ours
+    blocks.knownleases = set()
+    libs.configure_node_client(config)
+    libs.set_rate_limit(config.get('blocks', {}).get('requestspersecond', 10) / workers)
+
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    staging = sqlite3.connect(partial)
+    staging.executescript(SQL_STAGING)
+    tenant = StagingTenant(config, staging)
+    tenant.startblock = startblock
+
+    staged = 0
+    previousid = None
+    ranges = blocks.blockranges(startblock, endblock, libs.batchsize('/blocks/seq'))
+    for currentblocks, extended_map, _ in blocks.fetchpipeline(blocks.fetchblocks, ranges):
+        if blocks.chainbreak(previousid, currentblocks) is not None:
+            raise Exception(f"The chain changed while staging blocks {startblock} to {endblock}, run the backfill again.")
+        blocks.saveblocks([tenant], currentblocks, extended_map)
+        with staging:
+            staging.executemany(
+                "INSERT INTO staged_leaseops (cancel, params) VALUES (?, ?)",
+                [(sql == blocks.SQL_CANCELLEASE, json.dumps(params)) for sql, params in tenant.writebuffer.leaseops]
+            )
+            staging.executemany("INSERT INTO staged_blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", tenant.writebuffer.blocks)
+        tenant.writebuffer = blocks.WriteBuffer()
+        staged += len(currentblocks)
+        previousid = blocks.blockid(currentblocks[-1]) if currentblocks else previousid
+
+    staging.close()
+    os.replace(partial, path)
+    return staged
+
+def mergesegment(conn, path, previousid):
+    """
+    Applies a staged segment to waves_blocks, waves_leases and waves_lease_coverage in one
+    transaction, as blocks.getchainblocks writes a chunk. Returns the block rows.
+    """
+
+    staging = sqlite3.connect(path)
+    try:
+        rows = staging.execute("SELECT * FROM staged_blocks ORDER BY height").fetchall()
+        writebuffer = blocks.WriteBuffer()
+        for cancel, params in staging.execute("SELECT cancel, params FROM staged_leaseops ORDER BY seq"):
+            if cancel:
+                writebuffer.cancellease(tuple(json.loads(params)))
+            else:
+                writebuffer.savelease(tuple(json.loads(params)))
+    finally:
+        staging.close()
+
+    if rows and previousid is not None and rows[0][7] is not None and rows[0][7] != previousid:
+        raise Exception(f"Block {rows[0][0]} does not extend the stored chain, delete {path} and run the backfill again.")
+    for row in rows:
+        writebuffer.saveblock(row)
+    writebuffer.flush(conn)
+    return rows
+
+def removestale(directory, paths):
+    """
+    Deletes the staged segments of directory that are not in paths, e.g. the last segment
+    of an interrupted backfill resumed with another endblock, which would never be merged.
+    """
+
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        segment = path[:-len('.partial')] if path.endswith('.partial') else path
+        if STAGED_SEGMENT.fullmatch(filename) and segment not in paths:
+            logger.info(f"Deleting {path}, outside of the blocks to backfill")
+            os.remove(path)
+
+def backfill(conn, startblock, endblock):
+    """
+    Loads [startblock, endblock] with blocks.backfillworkers processes, each staging one
+    segment of blocks.backfillsegment blocks at a time in blocks.backfilldir. The segments
+    are merged in height order as they are staged, so the tables end up as a serial run
+    leaves them. Staged segments are kept until they are merged: an interrupted backfill
+    only fetches again the segments that were not staged, and deletes the staged segments
+    that are not in its range. Returns the number of merged blocks.
+    """
+
+    blocksconfig = config.get('blocks', {})
+    size = blocksconfig.get('backfillsegment', 10000)
+    workers = int(blocksconfig.get('backfillworkers') or os.cpu_count() or 1)
+    directory = blocksconfig.get('backfilldir', 'backfill')
+    os.makedirs(directory, exist_ok=True)
+    if blocksconfig.get('tenants'):
+        logger.warning("The backfill only loads the generator of config.json, not the blocks.tenants.")
+
+    plan = [(segstart, segend, stagingpath(directory, segstart, segend)) for segstart, segend in segments(startblock, endblock, size)]
+    removestale(directory, set(path for _, _, path in plan))
+    pending = [(config, path, segstart, segend, workers) for segstart, segend, path in plan if not os.path.exists(path)]
+    logger.info(f"Backfilling blocks {startblock} to {endblock} in {len(plan)} segments, {len(plan) - len(pending)} already staged, with {workers} workers")
+
+    previousid = blocks.storedblockid(conn, startblock - 1)
+    crediting = ledger.enabled(config)
+    merged = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {segment[1]: executor.submit(stagesegment, segment) for segment in pending}
+        try:
+            for segstart, segend, path in plan:
+                if path in futures:
+                    with metrics.stage('staging'):
+                        futures[path].result()
+                with metrics.stage('merge'):
+                    rows = mergesegment(conn, path, previousid)
+                os.remove(path)
+                metrics.process('merge', 'blocks', len(rows))
+
+                if crediting and rows:
+                    with metrics.stage('ledger'):
+                        ledger.credit(config, conn, segstart, segend, logger)
+
+                merged += len(rows)
+                previousid = rows[-1][6] if rows else previousid
+                logger.info(f"Merged blocks {segstart} to {segend}, {merged} blocks loaded")
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    # the lease ids known by the blocks module are stale
+    blocks.knownleases = None
+    return merged
+
+def defaultrange(conn, startblock, endblock):
+    """
+    By default, from the block after the last stored one to forkdepth blocks below the
+    node height, the blocks above are left to blocks.py.
+    """
+
+    if startblock is None:
+        row = conn.execute("SELECT MAX(height) FROM waves_blocks").fetchone()
+        startblock = (row[0] or 0) + 1
+    if endblock is None:
+        height = libs.height(libs.nodepool(config))
+        if height is None:
+            raise Exception('CURL error while fetching height.')
+        endblock = height - config.get('blocks', {}).get('forkdepth', 100)
+    return startblock, endblock
+
+config = None
+logger = None
+
+def main():
+
+    global config, logger
+
+    if len(sys.argv) > 3:
+        print("Usage: poetry run python backfill.py [startblock] [endblock]")
+        sys.exit(1)
+
+    success = False
+    try:
+        logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name="backfill")
+        config = libs.load_config_from_file('config.json')
+        libs.configure_node_client(config)
+        blocks.config = config
+        blocks.logger = logger
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
+
+        startblock = int(sys.argv[1]) if len(sys.argv) > 1 else None
+        endblock = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        blocks.validate_block_range(startblock, endblock)
+        startblock, endblock = defaultrange(conn, startblock, endblock)
+        if startblock > endblock:
+            logger.info("No blocks to backfill.")
+        else:
+            merged = backfill(conn, startblock, endblock)
+            logger.info(f"Backfilled {merged} blocks.")
+        conn.close()
+        success = True
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        metrics.write(config, 'backfill', success, logger)
+
+if __name__ == "__main__":
+    main()
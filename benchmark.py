@@ -0,0 +1,242 @@
+import sys
+import os
+import json
+import time
+import logging
+import platform
+import datetime
+import tempfile
+import subprocess
+import traceback
+import pywaves as pw
+import libs
+import migrate
+import blocks
+import calculatepayments
+import sendpayments
+import leasecoverage
+import stubnode
+
+# Synthetic chain parameters per scale, see stubnode.DEFAULT_PARAMS
+SCALES = {
+    'small': {'blocks': 2000, 'txsperblock': 5, 'leasers': 50, 'invokedepth': 2},
+    'medium': {'blocks': 10000, 'txsperblock': 10, 'leasers': 500, 'invokedepth': 3},
+    'large': {'blocks': 50000, 'txsperblock': 20, 'leasers': 5000, 'invokedepth': 4}
+}
+
+# Lease sets without a chain for the active lease engines alone, see stubnode.randomleases
+LEASE_SCALES = {
+    'leases10k': {'leases': 10000, 'addresses': 2000, 'blocks': 50000, 'minedblocks': 500},
+    'leases100k': {'leases': 100000, 'addresses': 20000, 'blocks': 50000, 'minedblocks': 500}
+}
+
+def benchmarkconfig(node, database):
+    return {
+        'waves': {
+            'chain': 'T',
+            'node': node,
+            'generatoraddress': stubnode.GENERATOR,
+            'generatoralias': stubnode.GENERATOR_ALIAS,
+            'nodeownerbeneficiaryaddress': stubnode.NODEOWNER,
+            'pk': '',
+            'percentagetodistribute': '95',
+            'distributionengine': 'python',
+            'airdrops': {}
+        },
+        'http': {'timeout': 30, 'retries': 0},
+        'blocks': {'mode': 'fullscan', 'fetchworkers': 4, 'fetchqueue': 8, 'requestspersecond': 0},
+        'database': database
+    }
+
+def timed(results, scale, stage, unit, func, *args):
+    """
+    Runs func(*args) and appends its timing to results. func returns the number
+    of processed items, a failing stage is recorded with its error.
+    """
+
+    global logger
+
+    result = {'scale': scale, 'stage': stage, 'unit': unit}
+    started = time.perf_counter()
+    try:
+        items = func(*args)
+        elapsed = time.perf_counter() - started
+        result.update(seconds=round(elapsed, 4), items=items, rate=round(items / elapsed, 1) if elapsed > 0 else None)
+        logger.info(f"{scale} {stage}: {items} {unit} in {elapsed:.2f}s")
+    except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        result.update(seconds=round(time.perf_counter() - started, 4), error=repr(e))
+        logger.error(f"{scale} {stage} failed: {e!r}")
+        logger.debug(traceback.format_exc())
+    results.append(result)
+
+def ingest(conn):
+    blocks.getallblocks(conn, None, None)
+    return conn.execute("SELECT COUNT(*) FROM waves_blocks").fetchone()[0]
+
+def activeleases_fullscan(heights, leases):
+    for height in heights:
+        calculatepayments.getwavesactiveleasesatblock(height, leases)
+    return len(heights)
+
+def activeleases_sweep(heights, leases, coverage):
+    for _ in leasecoverage.activeleasesatblocks(heights, leasecoverage.leaserows(leases), coverage):
+        pass
+    return len(heights)
+
+def distribution(engine, config, blocksinfo, balances, leases, coverage):
+    engine(config, blocksinfo, balances, leases, coverage)
+    return blocksinfo['minedblocks']
+
+def savedistribution(config, conn, blocksinfo, balances, leases, coverage):
+    """Saves a payment as calculatepayments does, for sendpayments.pay to process."""
+    payments = calculatepayments.distribute(config, blocksinfo, balances, leases, coverage)
+    totals = {}
+    for address, tokens in list(payments.items()):
+        for token, paymentdetails in list(tokens.items()):
+            if paymentdetails['reward'] <= 0:
+                del tokens[token]
+            else:
+                totals[token] = totals.get(token, 0) + int(paymentdetails['reward'])
+        if not tokens:
+            del payments[address]
+    calculatepayments.savepayments(config, conn, payments, blocksinfo, totals, 'N')
+    return len(payments)
+
+def pay(config, addr):
+    conn = libs.connect_db(config)
+    try:
+        recipients = conn.execute("SELECT COUNT(*) FROM waves_paymentdetails WHERE status = 'new'").fetchone()[0]
+        if not sendpayments.pay(config, conn, addr, 'Y'):
+            raise Exception("sendpayments.pay returned an error")
+        return recipients
+    finally:
+        conn.close()
+
+def runscale(scale, params, seed):
+    """Generates the chain of a scale, serves it and times every stage against it."""
+
+    global logger
+
+    results = []
+    started = time.perf_counter()
+    chain = stubnode.makechain(dict(params, seed=seed))
+    logger.info(f"{scale}: generated {len(chain['blocks'])} blocks, {len(chain['extended'])} transactions, {len(chain['leaseinfo'])} leases in {time.perf_counter() - started:.2f}s")
+    server, node = stubnode.serve(chain)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = benchmarkconfig(node, os.path.join(tmp, 'benchmark.db'))
+        for module in (blocks, calculatepayments, sendpayments):
+            module.config = config
+            module.logger = logger
+        blocks.knownleases = None
+        blocks.rawblockcache = None
+        libs.configure_node_client(config)
+        pw.setNode(node, config['waves']['chain'])
+
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
+        timed(results, scale, 'blocks.getallblocks', 'blocks', ingest, conn)
+        results[-1]['requests'] = server.requests
+        results[-1]['bytes'] = server.bytessent
+
+        blocksinfo = calculatepayments.loadblocksinfo(config, conn)
+        coverage = calculatepayments.getcoverageinfo(config, conn, blocksinfo['startblock'], blocksinfo['endblock'])
+        leases = calculatepayments.getleasesinfo(config, conn, blocksinfo['startblock'], blocksinfo['endblock'])
+        balances = {'waves': {'balance': 10 ** 16, 'assetid': None, 'decimals': 8}}
+        minedheights = [height for height, blockinfo in blocksinfo['blocks'].items() if blockinfo[1] == stubnode.GENERATOR]
+
+        timed(results, scale, 'calculatepayments.getwavesactiveleasesatblock', 'blocks', activeleases_fullscan, minedheights, leases)
+        timed(results, scale, 'leasecoverage.activeleasesatblocks', 'blocks', activeleases_sweep, minedheights, leases, coverage)
+        timed(results, scale, 'calculatepayments.distribute', 'blocks', distribution, calculatepayments.distribute, config, blocksinfo, balances, leases, coverage)
+        timed(results, scale, 'calculatepayments.distribute_parallel', 'blocks', distribution, calculatepayments.distribute_parallel, config, blocksinfo, balances, leases, coverage)
+        try:
+            import numpy
+            timed(results, scale, 'calculatepayments.distribute_numpy', 'blocks', distribution, calculatepayments.distribute_numpy, config, blocksinfo, balances, leases, coverage)
+        except ImportError:
+            logger.info("numpy is not installed, skipping distribute_numpy.")
+
+        savedistribution(config, conn, blocksinfo, balances, leases, coverage)
+        addr = pw.Address(seed='l0ps benchmark')
+        timed(results, scale, 'sendpayments.pay', 'payments', pay, config, addr)
+
+    server.shutdown()
+    server.server_close()
+    return results
+
+def runleases(scale, params, seed):
+    """Times the full scan and the sweep of active leases over a random lease set."""
+
+    results = []
+    leases = stubnode.randomleases(params['leases'], params['addresses'], params['blocks'], seed)
+    endblock = params['blocks'] + 2000
+    step = max(1, (endblock - leasecoverage.LOOKBACK) // params['minedblocks'])
+    heights = list(range(leasecoverage.LOOKBACK, endblock, step))[:params['minedblocks']]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = libs.connect_db({'database': os.path.join(tmp, 'leases.db')})
+        migrate.migrate(conn, logger)
+        conn.executemany(
+            "INSERT INTO waves_leases (tx_id, lease_id, txtype, address, start, leasedate, endleasedate, end, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(f"Tx{i}", f"Tx{i}", '8', address, start, start, end, end, amount) for i, (address, start, end, amount) in enumerate(leasecoverage.leaserows(leases))]
+        )
+        blocks.updatecoverage(conn.cursor(), leases.keys())
+        conn.commit()
+        windowleases = leasecoverage.loadleases(conn, heights[0], heights[-1])
+        coverage = leasecoverage.loadcoverage(conn, heights[0], heights[-1])
+        conn.close()
+
+    timed(results, scale, 'calculatepayments.getwavesactiveleasesatblock', 'blocks', activeleases_fullscan, heights, leases)
+    timed(results, scale, 'leasecoverage.activeleasesatblocks', 'blocks', activeleases_sweep, heights, leases, None)
+    timed(results, scale, 'leasecoverage.activeleasesatblocks coverage', 'blocks', activeleases_sweep, heights, windowleases, coverage)
+    for result in results:
+        result['leases'] = params['leases']
+    return results
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+
+    global logger
+
+    if len(sys.argv) > 3:
+        print("Usage: poetry run python benchmark.py [scales: small,medium,large,leases10k,leases100k] [output.json]")
+        sys.exit(1)
+
+    logger = libs.setup_logger(log_file="benchmark.log", log_level=logging.INFO, name="benchmark")
+
+    scales = sys.argv[1].split(',') if len(sys.argv) > 1 else ['small', 'medium']
+    for scale in scales:
+        if scale not in SCALES and scale not in LEASE_SCALES:
+            print(f"Unknown scale {scale}, expected one of {', '.join(list(SCALES) + list(LEASE_SCALES))}")
+            sys.exit(1)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scales': {scale: dict(stubnode.DEFAULT_PARAMS, **SCALES[scale], seed=1) if scale in SCALES else dict(LEASE_SCALES[scale], seed=1) for scale in scales},
+        'results': []
+    }
+    for scale in scales:
+        if scale in SCALES:
+            report['results'] += runscale(scale, SCALES[scale], seed=1)
+        else:
+            report['results'] += runleases(scale, LEASE_SCALES[scale], seed=1)
+
+    output = json.dumps(report, indent=2)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as f:
+            f.write(output + '\n')
+        logger.info(f"Results saved to {sys.argv[2]}")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
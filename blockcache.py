@@ -0,0 +1,71 @@
+import json
+import sqlite3
+import zlib
+
+class BlockCache:
+    """
+    Local store of the raw block and extended transaction JSON fetched from the node,
+    zlib compressed and indexed by height, used to rebuild the tables without a node.
+    Blocks are stored as the node sent them, so that a replay goes through the current
+    slimming and lease detection.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS raw_blocks (
+                height INTEGER NOT NULL,
+                block BLOB NOT NULL,
+                PRIMARY KEY (height)
+            );
+            CREATE TABLE IF NOT EXISTS raw_transactions (
+                id TEXT NOT NULL,
+                height INTEGER NOT NULL,
+                tx BLOB NOT NULL,
+                PRIMARY KEY (id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_raw_transactions_height ON raw_transactions (height);
+        """)
+
+    def store(self, blocks, extended_map):
+        """Saves a range of blocks and their extended transactions."""
+        with self.conn:
+            self.conn.executemany(
+                "REPLACE INTO raw_blocks (height, block) VALUES (?, ?)",
+                [(block['height'], compress(block)) for block in blocks]
+            )
+            self.conn.executemany(
+                "REPLACE INTO raw_transactions (id, height, tx) VALUES (?, ?, ?)",
+                [(tx_id, tx.get('height'), compress(tx)) for tx_id, tx in extended_map.items()]
+            )
+
+    def load(self, startblock, endblock):
+        """
+        Returns the cached blocks in [startblock, endblock] and their extended transactions,
+        raises an Exception if a block of the range is missing.
+        """
+        blocks = [decompress(row[0]) for row in self.conn.execute(
+            "SELECT block FROM raw_blocks WHERE height >= ? AND height <= ? ORDER BY height", (startblock, endblock)
+        )]
+        if len(blocks) != endblock - startblock + 1:
+            raise Exception(f"Block cache is missing blocks between {startblock} and {endblock}.")
+        extended_map = {}
+        for tx_id, tx in self.conn.execute(
+            "SELECT id, tx FROM raw_transactions WHERE height >= ? AND height <= ?", (startblock, endblock)
+        ):
+            extended_map[tx_id] = decompress(tx)
+        return blocks, extended_map
+
+    def heights(self):
+        """Returns the lowest and highest cached heights, (None, None) if the cache is empty."""
+        return self.conn.execute("SELECT MIN(height), MAX(height) FROM raw_blocks").fetchone()
+
+    def close(self):
+        self.conn.close()
+
+def compress(obj):
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode(), 6)
+
+def decompress(data):
+    return json.loads(zlib.decompress(data))
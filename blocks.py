@@ -1,8 +1,18 @@
 import sys
 import pywaves as pw
 import time
+import collections
+import concurrent.futures
+import functools
+import itertools
+import signal
+import threading
 import sqlite3
 import libs
+import blockcache
+import ledger
+import metrics
+import migrate
 import logging
 import traceback
 import json
@@ -16,6 +26,172 @@ TRANSACTION_TYPES = {
     'INVOKE_SCRIPT': 18
 }
 
+# Fields of blocks and transactions used by saveblocks and checkandsave_leasetransaction,
+# the rest of the node responses is dropped while they are decoded, or once they are
+# stored when the block cache is enabled
+BLOCK_FIELDS = ('height', 'generator', 'totalFee', 'timestamp', 'id', 'signature', 'reference')
+TRANSACTION_FIELDS = ('id', 'type', 'height', 'timestamp', 'sender', 'recipient', 'amount', 'leaseId')
+
+SQL_SAVEBLOCK = """
+    REPLACE INTO waves_blocks (height, generator, fees, txs, timestamp, tx16calls, blockid, reference)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_SAVELEASE = """
+    REPLACE INTO waves_leases (tx_id, lease_id, txtype, address, start, leasedate, end, amount)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_CANCELLEASE = """
+    UPDATE waves_leases
+    SET end = ?,
+        endleasedate = ?
+    WHERE lease_id = ?
+"""
+
+# Merges the leases of an address into maximal covered segments: a lease starting
+# at or before the highest end seen so far extends the current segment. The segments
+# only prefilter the addresses calculatepayments loads leases for, the amounts are
+# always computed from the leases.
+SQL_SAVECOVERAGE = """
+    INSERT INTO waves_lease_coverage (address, covered_from, covered_to)
+    WITH leases AS (
+        SELECT rowid AS id, address, start, COALESCE(end, 9223372036854775807) AS end
+        FROM waves_leases
+        WHERE address = ?
+    ), ordered AS (
+        SELECT address, start, end, id,
+            MAX(end) OVER (ORDER BY start, end, id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS previousend
+        FROM leases
+    ), segments AS (
+        SELECT address, start, end,
+            SUM(CASE WHEN previousend IS NULL OR start > previousend THEN 1 ELSE 0 END) OVER (ORDER BY start, end, id ROWS UNBOUNDED PRECEDING) AS segment
+        FROM ordered
+    )
+    SELECT address, MIN(start), NULLIF(MAX(end), 9223372036854775807)
+    FROM segments
+    GROUP BY segment
+"""
+
+class WriteBuffer:
+    """
+    Collects block rows, new leases and lease cancellations of a chunk and writes
+    them with executemany in a single transaction.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.leaseops = []
+        self.leaseids = set()
+        self.cancelids = set()
+        self.addresses = set()
+
+    def saveblock(self, row):
+        self.blocks.append(row)
+
+    def savelease(self, row):
+        self.leaseops.append((SQL_SAVELEASE, row))
+        self.leaseids.add(row[1])
+        self.addresses.add(row[3])
+
+    def cancellease(self, row):
+        self.leaseops.append((SQL_CANCELLEASE, row))
+        self.cancelids.add(row[2])
+
+    def flush(self, conn):
+        """
+        Writes and commits the buffered rows, returns the number of rows written.
+        Leases and cancellations are applied in the order they were found, then the
+        lease coverage of the addresses they belong to is rebuilt.
+        """
+        rows = 0
+        with metrics.stage('sqlite_write'), conn:
+            cursor = conn.cursor()
+            for sql, ops in itertools.groupby(self.leaseops, key=lambda op: op[0]):
+                cursor.executemany(sql, [params for _, params in ops])
+                if sql == SQL_CANCELLEASE and cursor.rowcount > 0:
+                    logger.debug(f"Applied {cursor.rowcount} lease cancellations")
+                metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_leases')
+                rows += max(cursor.rowcount, 0)
+            cursor.executemany(SQL_SAVEBLOCK, self.blocks)
+            metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_blocks')
+            rows += max(cursor.rowcount, 0)
+            self.addresses.update(leaseaddresses(cursor, self.cancelids))
+            updatecoverage(cursor, self.addresses)
+            cursor.close()
+        self.blocks = []
+        self.leaseops = []
+        self.leaseids = set()
+        self.cancelids = set()
+        self.addresses = set()
+        return rows
+
+class Tenant:
+    """
+    A generator ingested by the chain scan into its own database: its config, connection,
+    known lease ids and write buffer. Blocks from startblock on are saved for it.
+    """
+
+    def __init__(self, config, conn):
+        self.config = config
+        self.conn = conn
+        self.generator = config['waves']['generatoraddress']
+        self.recipients = {self.generator, "address:" + self.generator, "alias:W:" + config['waves'].get('generatoralias', '')}
+        self.knownleases = set()
+        self.writebuffer = WriteBuffer()
+        self.startblock = None
+
+    def knows(self, lease_id):
+        return lease_id in self.knownleases or lease_id in self.writebuffer.leaseids
+
+def gettenants(conn):
+    """
+    Returns the tenant of config and conn, followed by the tenants of the config files
+    listed in blocks.tenants, whose databases are opened and migrated once.
+    """
+
+    global tenantcache, knownleases
+
+    if tenantcache is None or tenantcache[0].conn is not conn:
+        tenants = [Tenant(config, conn)]
+        for path in config.get('blocks', {}).get('tenants', []):
+            tenantconfig = libs.load_config_from_file(path)
+            tenantconn = libs.connect_db(tenantconfig)
+            migrate.migrate(tenantconn, logger)
+            tenants.append(Tenant(tenantconfig, tenantconn))
+
+        databases = [tenant.config['database'] for tenant in tenants]
+        generators = [tenant.generator for tenant in tenants]
+        if len(set(databases)) < len(databases) or len(set(generators)) < len(generators):
+            raise Exception("Every tenant in blocks.tenants needs its own generatoraddress and database.")
+        tenantcache = tenants
+        knownleases = None
+    return tenantcache
+
+def leaseaddresses(cursor, lease_ids):
+    """
+    Returns the addresses of the recorded leases among lease_ids.
+    """
+
+    lease_ids = list(lease_ids)
+    addresses = set()
+    for i in range(0, len(lease_ids), 500):
+        chunk = lease_ids[i:i + 500]
+        cursor.execute(f"SELECT DISTINCT address FROM waves_leases WHERE lease_id IN ({','.join('?' * len(chunk))})", chunk)
+        addresses.update(row[0] for row in cursor.fetchall())
+    return addresses
+
+def updatecoverage(cursor, addresses):
+    """
+    Rebuilds the waves_lease_coverage segments of addresses from their leases.
+    """
+
+    rows = [(address,) for address in sorted(addresses)]
+    cursor.executemany("DELETE FROM waves_lease_coverage WHERE address = ?", rows)
+    for row in rows:
+        cursor.execute(SQL_SAVECOVERAGE, row)
+        metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_lease_coverage')
+
 def getallblocks(conn: sqlite3.Connection, startblock: Optional[int], endblock: Optional[int]) -> None:
     """
     Get blocks from startblock to endblock and analyze leases, unleases, and rewards.
@@ -31,9 +207,16 @@ def getallblocks(conn: sqlite3.Connection, startblock: Optional[int], endblock:
     """
         
     global config, logger
-    height = libs.height(config['waves']['node'])
+    height = libs.height(libs.nodepool(config))
+    if height is None:
+        raise Exception('CURL error while fetching height.')
     logger.info(f"Height: {height}")
 
+    blocksconfig = config.get('blocks', {})
+    tenants = gettenants(conn)
+    if len(tenants) > 1 and blocksconfig.get('mode', 'fullscan') == 'address':
+        raise Exception("blocks.tenants needs blocks.mode fullscan, the address mode scans the history of a single generator.")
+
     _startblock = startblock
     _endblock = endblock    
     
@@ -42,142 +225,607 @@ def getallblocks(conn: sqlite3.Connection, startblock: Optional[int], endblock:
     if _endblock is None:
         _endblock = height - 1
     
-    if _startblock is None:
-        # Load from 1 block before
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT MAX(height) + 1 AS startblock FROM waves_blocks")
-        row = cursor.fetchone()
-        _startblock = row[0] if row[0] else 1 #if row[0] is none, start from block 1
-        cursor.close()
+    for tenant in tenants:
+        tenant.startblock = _startblock
+        if _startblock is None:
+            # Roll back the blocks that are no longer on the node chain
+            with metrics.stage('fork_check'):
+                forkheight = findfork(tenant.conn, blocksconfig.get('forkdepth', 100))
+                if forkheight is not None:
+                    rollback(tenant.conn, forkheight)
+
+            # Load from 1 block before
+            cursor = tenant.conn.cursor()
+            cursor.execute(f"SELECT MAX(height) + 1 AS startblock FROM waves_blocks")
+            row = cursor.fetchone()
+            tenant.startblock = row[0] if row[0] else 1 #if row[0] is none, start from block 1
+            cursor.close()
+    _startblock = min(tenant.startblock for tenant in tenants)
+
+    if _startblock > _endblock:
+        logger.info("No new blocks to load.")
+        return
 
     logger.info(f"Loading Blocks from {_startblock} to {_endblock}")
+    if len(tenants) > 1:
+        for tenant in tenants:
+            logger.info(f"Tenant {tenant.generator}: from block {tenant.startblock} into {tenant.config['database']}")
 
-    steps = 100
-    totalsavedblocks = 0
-    while _startblock < _endblock:
-        currentblocks = []
-        if _startblock + (steps - 1) < _endblock:
-            logger.info("Getting blocks from %d to %d" % ( _startblock, _startblock + (steps - 1)))                        
-            res = libs.wrapper(config['waves']['node'], '/blocks/seq/%d/%d' % (_startblock, _startblock + (steps - 1)))
-            if res is not None:
-                currentblocks = res
-            else:
-                raise Exception('CURL error while fetching blocks.')
+    libs.set_rate_limit(blocksconfig.get('requestspersecond', 10))
+    started = time.monotonic()
+
+    with metrics.stage('ingest'):
+        if blocksconfig.get('mode', 'fullscan') == 'address' and not invokeleasing(conn):
+            totalsavedblocks = getaddressblocks(conn, _startblock, _endblock)
         else:
-            logger.info("Getting blocks from %d to %d" % ( _startblock, _endblock))
-            res = libs.wrapper(config['waves']['node'], '/blocks/seq/%d/%d' % (_startblock, _endblock))
-            if res is not None:
-                currentblocks = res
-            else:
-                raise Exception('CURL error while fetching blocks.')
-
-        time.sleep(1)
-
-        # Collect all relevant transaction ids from all currentblocks
-        tx_ids = []
-        for block in currentblocks:
-            tx_ids.extend([tx['id'] for tx in block['transactions'] if tx['type'] in (
-                TRANSACTION_TYPES['LEASE_CANCEL'],
-                TRANSACTION_TYPES['INVOKE'],
-                TRANSACTION_TYPES['INVOKE_SCRIPT']
-            )])
+            totalsavedblocks = getchainblocks(tenants, _startblock, _endblock)
+    metrics.process('ingest', 'blocks', totalsavedblocks or 0)
+
+    elapsed = time.monotonic() - started
+    if totalsavedblocks and elapsed > 0:
+        logger.info(f"Ingested {totalsavedblocks} blocks in {elapsed:.1f}s ({totalsavedblocks / elapsed:.1f} blocks/s)")
+    libs.log_batch_stats(logger)
+
+def getchainblocks(tenants, startblock, endblock, replay=False):
+    """
+    Full chain scan: downloads every block and the extended info of every lease cancel
+    and invoke once, saving them for every tenant, returns the number of scanned blocks.
+    With replay, blocks are read from the raw block cache instead of the node. Cached
+    blocks are slimmed after they are stored or loaded.
+    """
+
+    global knownleases
+
+    if knownleases is None:
+        for tenant in tenants:
+            tenant.knownleases = loadknownleases(tenant.conn)
+        # the cancels of leases none of the tenants knows are not looked up
+        knownleases = tenants[0].knownleases if len(tenants) == 1 else set().union(*(tenant.knownleases for tenant in tenants))
+
+    cache = getblockcache()
+    if replay:
+        chunks = (loadcachedblocks(cache, *blockrange) for blockrange in blockranges(startblock, endblock, 100))
+    else:
+        chunks = fetchpipeline(functools.partial(fetchblocks, raw=cache is not None), blockranges(startblock, endblock, libs.batchsize('/blocks/seq')))
+
+    totalsavedblocks = 0
+    totalcancels = 0
+    totalskipped = 0
+
+    previousid = storedblockid(next(tenant.conn for tenant in tenants if tenant.startblock == startblock), startblock - 1)
+    crediting = [tenant for tenant in tenants if ledger.enabled(tenant.config)] if not replay else []
+    if replay and any(ledger.enabled(tenant.config) for tenant in tenants):
+        logger.warning("Replayed blocks are not credited to the reward ledger, run: poetry run python ledger.py rebuild")
+
+    for currentblocks, extended_map, skipped in chunks:
+        forked = chainbreak(previousid, currentblocks)
+        currentblocks = currentblocks[:forked]
+        if cache is not None and not replay:
+            with metrics.stage('cache_store'):
+                cache.store(currentblocks, extended_map)
+        with metrics.stage('parse'):
+            if cache is not None:
+                currentblocks = [slimblock(block) for block in currentblocks]
+                extended_map = {tx_id: slimtransaction(tx) for tx_id, tx in extended_map.items()}
+            saveblocks(tenants, currentblocks, extended_map)
+        metrics.process('parse', 'blocks', len(currentblocks))
+        metrics.process('parse', 'leases', sum(len(tenant.writebuffer.leaseops) for tenant in tenants))
+        for tenant in tenants:
+            tenant.knownleases.update(tenant.writebuffer.leaseids)
+            knownleases.update(tenant.writebuffer.leaseids)
+
+        totalcancels += sum(1 for block in currentblocks for tx in block['transactions'] if tx['type'] == TRANSACTION_TYPES['LEASE_CANCEL'])
+        totalskipped += skipped
+        totalsavedblocks += len(currentblocks)
+        logger.info(f"Total Blocks Loaded: {totalsavedblocks}, committing...")
+        for tenant in tenants:
+            if not tenant.writebuffer.blocks:
+                continue
+            try:
+                tenant.writebuffer.flush(tenant.conn)
+            except sqlite3.Error as e:
+                logger.error(f"Database error: {e}")
+                raise
+
+            if tenant in crediting:
+                with metrics.stage('ledger'):
+                    ledger.credit(tenant.config, tenant.conn, max(currentblocks[0]['height'], tenant.startblock), currentblocks[-1]['height'], logger)
+
+        # the range may come from a pool node on another chain, exclude it before the next run
+        if forked is not None and not replay:
+            libs.nodepool(config).check(force=True)
+
+        if forked is not None or stopping.is_set():
+            break
+        previousid = blockid(currentblocks[-1]) if currentblocks else previousid
+
+    if totalcancels:
+        logger.info(f"Skipped extended lookup of {totalskipped} of {totalcancels} lease cancels of unknown leases ({100 * totalskipped / totalcancels:.1f}%)")
+
+    return totalsavedblocks
+
+def getblockcache():
+    """
+    Returns the raw block cache configured in blocks.cache, None if caching is disabled.
+    """
+
+    global rawblockcache
+
+    if rawblockcache is None and config.get('blocks', {}).get('cache'):
+        rawblockcache = blockcache.BlockCache(config['blocks']['cache'])
+    return rawblockcache
+
+def loadcachedblocks(cache, startblock, endblock):
+    """
+    Reads a range of blocks from the raw block cache, in the same form as fetchblocks.
+    """
+
+    logger.info("Replaying blocks from %d to %d" % (startblock, endblock))
+    with metrics.stage('cache_load'):
+        currentblocks, extended_map = cache.load(startblock, endblock)
+    skipped = sum(
+        1 for block in currentblocks for tx in block['transactions']
+        if tx['type'] == TRANSACTION_TYPES['LEASE_CANCEL'] and tx['id'] not in extended_map
+    )
+    return currentblocks, extended_map, skipped
+
+def replayblocks(conn, startblock, endblock):
+    """
+    Rebuilds waves_blocks and waves_leases from the raw block cache, without a node.
+    """
+
+    cache = getblockcache()
+    if cache is None:
+        raise Exception("Replay needs a raw block cache, set blocks.cache in config.json.")
+
+    cachedstart, cachedend = cache.heights()
+    if cachedstart is None:
+        raise Exception("The raw block cache is empty.")
+    startblock = cachedstart if startblock is None else startblock
+    endblock = cachedend if endblock is None else endblock
+
+    logger.info(f"Replaying Blocks from {startblock} to {endblock}")
+    started = time.monotonic()
+    tenants = gettenants(conn)
+    for tenant in tenants:
+        tenant.startblock = startblock
+    totalsavedblocks = getchainblocks(tenants, startblock, endblock, replay=True)
+    elapsed = time.monotonic() - started
+    if totalsavedblocks and elapsed > 0:
+        logger.info(f"Replayed {totalsavedblocks} blocks in {elapsed:.1f}s ({totalsavedblocks / elapsed:.1f} blocks/s)")
+
+def blockid(block):
+    """
+    Returns the id of a block or block header, older nodes only expose the signature.
+    """
+
+    return block.get('id', block.get('signature'))
+
+def storedblockid(conn, height):
+    row = conn.execute("SELECT blockid FROM waves_blocks WHERE height = ?", (height,)).fetchone()
+    return row[0] if row else None
+
+def chainbreak(previousid, currentblocks):
+    """
+    Returns the index of the first block that does not reference the block before it,
+    None if the blocks extend previousid. Unknown ids are not checked.
+    """
+
+    for i, block in enumerate(currentblocks):
+        if previousid is not None and block.get('reference') is not None and block['reference'] != previousid:
+            logger.warning(f"Block {block['height']} does not extend the stored chain, stopping: the next run will roll back.")
+            return i
+        previousid = blockid(block)
+    return None
+
+def findfork(conn, depth):
+    """
+    Compares the ids of the last stored blocks with the node, starting with the last depth
+    blocks and going deeper while they all differ. Returns the first diverging height, None
+    if the stored chain is still on the node chain.
+    """
+
+    while True:
+        rows = conn.execute("SELECT height, blockid FROM waves_blocks WHERE blockid IS NOT NULL ORDER BY height DESC LIMIT ?", (depth,)).fetchall()
+        if not rows:
+            return None
+        rows.reverse()
+
+        nodeids = {}
+        for startblock, endblock in blockranges(rows[0][0], rows[-1][0], 100):
+            nodeids.update((header['height'], blockid(header)) for header in fetchheaders(libs.nodepool(config), startblock, endblock))
+
+        forkheight = next((height for height, stored in rows if nodeids.get(height) != stored), None)
+        if forkheight is None or forkheight > rows[0][0] or len(rows) < depth:
+            return forkheight
+        depth *= 2
 
-        # Fetch extended tx info
-        extended_map = {}
-        extended_transactions = libs.tx_bulk(config['waves']['node'], tx_ids)
-        logger.debug(f"Found {len(tx_ids)} txs")
-        extended_map.update({tx['id']: tx for tx in extended_transactions})
+def rollback(conn, height):
+    """
+    Removes the blocks from height onwards, with the leases they created and the
+    cancellations they applied.
+    """
+
+    global knownleases
 
-        # Process blocks and transactions
+    logger.warning(f"Chain diverged at height {height}, rolling back.")
+    row = conn.execute("SELECT MAX(endblock) FROM waves_payments").fetchone()
+    if row[0] is not None and row[0] >= height:
+        logger.warning(f"Rolled back blocks were already paid up to {row[0]}, check the last payment.")
+
+    with conn:
         cursor = conn.cursor()
-        for block in currentblocks:            
-            total_tx16calls = 0
-            for transaction in block['transactions']:                
-                if transaction['type'] in (
-                    TRANSACTION_TYPES['LEASE'],
-                    TRANSACTION_TYPES['LEASE_CANCEL'],
-                    TRANSACTION_TYPES['INVOKE'],
-                    TRANSACTION_TYPES['INVOKE_SCRIPT']
-                ):
-                    extended_tx = extended_map.get(transaction['id'])
-                    tx16calls = checkandsave_leasetransaction(conn, block, transaction, extended_tx)
-                    total_tx16calls += tx16calls
-            # save block data
-            sql = f"""
-                REPLACE INTO waves_blocks ( height, generator, fees, txs, timestamp, tx16calls)
-                VALUES (
-                    {block['height']},
-                    '{block['generator']}',
-                    {block['totalFee'] },
-                    {len(block['transactions'])},
-                    {block['timestamp'] // 1000},
-                    {total_tx16calls}
-                )"""
-            
-            cursor.execute(sql)    
+        cursor.execute("SELECT DISTINCT address FROM waves_leases WHERE start >= ? OR end >= ?", (height, height))
+        addresses = set(row[0] for row in cursor.fetchall())
+        cursor.execute("DELETE FROM waves_blocks WHERE height >= ?", (height,))
+        cursor.execute("DELETE FROM waves_leases WHERE start >= ?", (height,))
+        cursor.execute("UPDATE waves_leases SET end = NULL, endleasedate = NULL WHERE end >= ?", (height,))
+        updatecoverage(cursor, addresses)
+        ledger.rollback(cursor, height)
         cursor.close()
-        
-        if _startblock + steps < _endblock:
-            _startblock += steps
-        else:
-            _startblock = _endblock
 
-        totalsavedblocks += len(currentblocks)
+    knownleases = None
+
+def loadknownleases(conn):
+    """
+    Returns the set of the lease ids recorded in waves_leases.
+    """
+
+    return set(row[0] for row in conn.execute("SELECT lease_id FROM waves_leases"))
+
+def invokeleasing(conn):
+    """
+    Returns True if dApps lease to the generator: a stored lease or an active one was
+    created by an invoke. The address history only lists the invokes of a lease created
+    and cancelled between two runs if the node indexes invoke state changes by recipient,
+    so such a generator is scanned in full.
+    """
+
+    stored = conn.execute(
+        "SELECT 1 FROM waves_leases WHERE txtype IN (?, ?) LIMIT 1",
+        (TRANSACTION_TYPES['INVOKE'], TRANSACTION_TYPES['INVOKE_SCRIPT'])
+    ).fetchone()
+    if stored is None:
+        with metrics.stage('lease_info'):
+            active = libs.active_leases(libs.nodepool(config), config['waves']['generatoraddress'])
+        # the id of a lease transaction lease is the transaction id
+        if not any(lease['id'] != lease['originTransactionId'] for lease in active):
+            return False
+    logger.warning("The generator has leases created by invokes, which the address mode can miss: scanning the whole chain.")
+    return True
+
+def getaddressblocks(conn, startblock, endblock):
+    """
+    Address-scoped scan: discovers leases and cancellations from the generator
+    transaction history, active leases and lease status endpoints, and only
+    downloads block headers. Returns the number of saved blocks. Leases created
+    by invokes are only found if the node lists these invokes in the history of
+    the generator, getallblocks scans the chain for a generator that has some.
+    """
+
+    node = libs.nodepool(config)
+    generator = config['waves']['generatoraddress']
+    tenant = Tenant(config, conn)
+    tenant.knownleases = loadknownleases(conn)
+    routes = {recipient: tenant for recipient in tenant.recipients}
+    writebuffer = tenant.writebuffer
+    tx16calls = {}
+
+    # Leases, cancels and invokes involving the generator, oldest first
+    with metrics.stage('address_history'):
+        history = [tx for tx in libs.address_transactions(node, generator, startblock) if startblock <= tx['height'] <= endblock]
+    history.reverse()
+    metrics.process('address_history', 'transactions', len(history))
+    tx_ids = [tx['id'] for tx in history if tx['type'] in (
+        TRANSACTION_TYPES['LEASE_CANCEL'],
+        TRANSACTION_TYPES['INVOKE'],
+        TRANSACTION_TYPES['INVOKE_SCRIPT']
+    )]
+    with metrics.stage('tx_bulk'):
+        extended_map = {tx['id']: tx for tx in libs.tx_bulk(node, tx_ids, transform=slimtransaction)}
+
+    for transaction in history:
+        if transaction['type'] in (
+            TRANSACTION_TYPES['LEASE'],
+            TRANSACTION_TYPES['LEASE_CANCEL'],
+            TRANSACTION_TYPES['INVOKE'],
+            TRANSACTION_TYPES['INVOKE_SCRIPT']
+        ):
+            block = {'height': transaction['height']}
+            calls = collections.Counter()
+            checkandsave_leasetransaction(routes, block, transaction, extended_map.get(transaction['id']), calls)
+            tx16calls[transaction['height']] = tx16calls.get(transaction['height'], 0) + calls[tenant]
+
+    # Active leases created in the range that are not in the history (e.g. invoke leases)
+    known = tenant.knownleases
+    with metrics.stage('lease_info'):
+        missing = [
+            lease for lease in libs.active_leases(node, generator)
+            if lease['id'] not in known and lease['id'] not in writebuffer.leaseids and startblock <= lease['height'] <= endblock
+        ]
+    with metrics.stage('tx_bulk'):
+        origins = {tx['id']: tx for tx in libs.tx_bulk(node, [lease['originTransactionId'] for lease in missing], transform=slimtransaction)}
+    for lease in missing:
+        origin = origins[lease['originTransactionId']]
+        logger.debug(f"Block: {lease['height']}: Found an active lease... id: {lease['id']}, saving it.")
+        writebuffer.savelease((
+            origin['id'],
+            lease['id'],
+            origin['type'],
+            lease['sender'],
+            lease['height'],
+            origin['timestamp'] // 1000,
+            None,
+            lease['amount'],
+        ))
+
+    # Cancellations of open leases
+    openleases = set(row[0] for row in conn.execute("SELECT lease_id FROM waves_leases WHERE end IS NULL"))
+    openleases.update(writebuffer.leaseids)
+    openleases.difference_update(writebuffer.cancelids)
+    with metrics.stage('lease_info'):
+        cancelled = [
+            lease for lease in libs.lease_info_bulk(node, sorted(openleases))
+            if lease['status'] == 'canceled' and lease['cancelHeight'] is not None and lease['cancelHeight'] <= endblock
+        ]
+    with metrics.stage('tx_bulk'):
+        canceltxs = {tx['id']: tx for tx in libs.tx_bulk(node, list(set(lease['cancelTransactionId'] for lease in cancelled)), transform=slimtransaction)}
+    for lease in sorted(cancelled, key=lambda lease: lease['cancelHeight']):
+        logger.debug(f"Block: {lease['cancelHeight']}: Found a lease cancellation... id: {lease['id']}")
+        writebuffer.cancellease((
+            lease['cancelHeight'],
+            canceltxs[lease['cancelTransactionId']]['timestamp'] // 1000,
+            lease['id'],
+        ))
+
+    logger.info(f"Found {len(writebuffer.leaseids)} leases and {len(writebuffer.cancelids)} cancellations, committing...")
+    metrics.process('lease_info', 'leases', len(writebuffer.leaseids) + len(writebuffer.cancelids))
+    writebuffer.flush(conn)
+
+    totalsavedblocks = 0
+    previousid = storedblockid(conn, startblock - 1)
+    for headers in fetchpipeline(fetchheaders, blockranges(startblock, endblock, libs.batchsize('/blocks/headers'))):
+        forked = chainbreak(previousid, headers)
+        headers = headers[:forked]
+        for header in headers:
+            writebuffer.saveblock((
+                header['height'],
+                header['generator'],
+                header['totalFee'],
+                header['transactionCount'],
+                header['timestamp'] // 1000,
+                tx16calls.get(header['height'], 0),
+                blockid(header),
+                header.get('reference')
+            ))
+
+        totalsavedblocks += len(headers)
         logger.info(f"Total Blocks Loaded: {totalsavedblocks}, committing...")
         try:
-            with conn:  # This ensures proper transaction handling
-                conn.commit()
+            writebuffer.flush(conn)
         except sqlite3.Error as e:
             logger.error(f"Database error: {e}")
             raise
-        time.sleep(1)
+
+        if ledger.enabled(config) and headers:
+            with metrics.stage('ledger'):
+                ledger.credit(config, conn, headers[0]['height'], headers[-1]['height'], logger)
+
+        if forked is not None or stopping.is_set():
+            break
+        previousid = blockid(headers[-1]) if headers else previousid
+
+    return totalsavedblocks
+
+def fetchpipeline(fetch, ranges):
+    """
+    Runs fetch(node, from, to) for every range on a thread pool, up to blocks.fetchqueue
+    ranges ahead of the consumer, and yields the results strictly in range order.
+    """
+
+    node = libs.nodepool(config)
+    blocksconfig = config.get('blocks', {})
+    fetchworkers = blocksconfig.get('fetchworkers', 4)
+    fetchqueue = blocksconfig.get('fetchqueue', 2 * fetchworkers)
+    pending = collections.deque()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=fetchworkers) as executor:
+        try:
+            for blockrange in itertools.islice(ranges, fetchqueue):
+                pending.append(executor.submit(fetch, node, *blockrange))
+
+            while pending:
+                result = pending.popleft().result()
+                for blockrange in itertools.islice(ranges, 1):
+                    pending.append(executor.submit(fetch, node, *blockrange))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+def blockranges(startblock, endblock, steps):
+    """
+    Yields (from, to) block ranges of at most steps blocks covering [startblock, endblock],
+    steps is a number or a libs.BatchSize read as every range is taken.
+    """
+    while startblock <= endblock:
+        size = steps.size if isinstance(steps, libs.BatchSize) else steps
+        yield startblock, min(startblock + (size - 1), endblock)
+        startblock += size
+
+def fetchblocks(node, startblock, endblock, raw=False):
+    """
+    Fetches a range of blocks and the extended info of the transactions that need it.
+    Cancels of leases that are not known when the range is fetched are skipped,
+    returns the blocks, the extended transactions and the number of skipped cancels.
+    With raw, blocks and transactions are returned as the node sent them, not slimmed,
+    and no cancel is skipped, so that the block cache holds the extended info of all.
+    """
+
+    logger.info("Getting blocks from %d to %d" % (startblock, endblock))
+    with metrics.stage('fetch_blocks'):
+        res = libs.wrapper(node, '/blocks/seq/%d/%d' % (startblock, endblock), transform=None if raw else slimblock, items=endblock - startblock + 1)
+    if isinstance(res, list):
+        currentblocks = res
+    else:
+        raise Exception('CURL error while fetching blocks.')
+
+    # Collect all relevant transaction ids from all currentblocks
+    tx_ids = []
+    skipped = 0
+    for block in currentblocks:
+        for tx in block['transactions']:
+            if tx['type'] == TRANSACTION_TYPES['LEASE_CANCEL'] and not raw and tx['leaseId'] not in knownleases:
+                skipped += 1
+            elif tx['type'] in (
+                TRANSACTION_TYPES['LEASE_CANCEL'],
+                TRANSACTION_TYPES['INVOKE'],
+                TRANSACTION_TYPES['INVOKE_SCRIPT']
+            ):
+                tx_ids.append(tx['id'])
+
+    # Fetch extended tx info
+    extended_map = {}
+    with metrics.stage('tx_bulk'):
+        extended_transactions = libs.tx_bulk(node, tx_ids, transform=None if raw else slimtransaction)
+    metrics.process('tx_bulk', 'transactions', len(tx_ids))
+    logger.debug(f"Found {len(tx_ids)} txs")
+    extended_map.update({tx['id']: tx for tx in extended_transactions})
+
+    return currentblocks, extended_map, skipped
+
+def fetchheaders(node, startblock, endblock):
+    """
+    Fetches the headers of a range of blocks.
+    """
+
+    logger.info("Getting block headers from %d to %d" % (startblock, endblock))
+    with metrics.stage('fetch_headers'):
+        res = libs.wrapper(node, '/blocks/headers/seq/%d/%d' % (startblock, endblock), items=endblock - startblock + 1)
+    if isinstance(res, list):
+        return res
+    raise Exception('CURL error while fetching block headers.')
+
+def slimblock(block):
+    """
+    Keeps the fields of a block, and of its lease and invoke transactions, that are saved.
+    """
+
+    if not isinstance(block, dict) or 'transactions' not in block:
+        return block
+    slim = {field: block[field] for field in BLOCK_FIELDS if field in block}
+    slim['transactionCount'] = block.get('transactionCount', len(block['transactions']))
+    slim['transactions'] = [slimtransaction(tx) for tx in block['transactions'] if tx['type'] in TRANSACTION_TYPES.values()]
+    return slim
+
+def slimtransaction(transaction):
+    """
+    Keeps the fields of a transaction, and the leases of its state changes, that are saved.
+    """
+
+    if not isinstance(transaction, dict):
+        return transaction
+    slim = {field: transaction[field] for field in TRANSACTION_FIELDS if field in transaction}
+    if isinstance(transaction.get('lease'), dict):
+        slim['lease'] = {'recipient': transaction['lease'].get('recipient')}
+    if 'stateChanges' in transaction:
+        slim['stateChanges'] = slimstatechanges(transaction['stateChanges'])
+    if isinstance(transaction.get('payload'), dict):
+        slim['payload'] = {}
+        if 'stateChanges' in transaction['payload']:
+            slim['payload']['stateChanges'] = slimstatechanges(transaction['payload']['stateChanges'])
+    return slim
+
+def slimstatechanges(statechanges):
+    """
+    Keeps the leases, lease cancels and nested invokes analyzestatechanges walks.
+    """
+
+    if not isinstance(statechanges, dict):
+        return statechanges
+    slim = {key: statechanges[key] for key in ('leases', 'leaseCancels') if key in statechanges}
+    if 'invokes' in statechanges:
+        invokes = statechanges['invokes']
+        if isinstance(invokes, list):
+            invokes = [
+                {'stateChanges': slimstatechanges(invoke['stateChanges'])} if isinstance(invoke, dict) and 'stateChanges' in invoke else {}
+                for invoke in invokes
+            ]
+        slim['invokes'] = invokes
+    return slim
+
+def saveblocks(tenants, currentblocks, extended_map):
+    """
+    Process blocks and transactions once, buffering leases and block data for the
+    tenants that load each block.
+    """
+
+    for block in currentblocks:            
+        receiving = [tenant for tenant in tenants if block['height'] >= tenant.startblock]
+        routes = {recipient: tenant for tenant in receiving for recipient in tenant.recipients}
+        tx16calls = collections.Counter()
+        for transaction in block['transactions']:                
+            if transaction['type'] in (
+                TRANSACTION_TYPES['LEASE'],
+                TRANSACTION_TYPES['LEASE_CANCEL'],
+                TRANSACTION_TYPES['INVOKE'],
+                TRANSACTION_TYPES['INVOKE_SCRIPT']
+            ):
+                extended_tx = extended_map.get(transaction['id'])
+                if extended_tx is None and transaction['type'] == TRANSACTION_TYPES['LEASE_CANCEL']:
+                    owner = next((tenant for tenant in receiving if tenant.knows(transaction['leaseId'])), None)
+                    if owner is None:
+                        continue
+                    # The lease was found after this range was fetched: it is one of ours,
+                    # so the cancel details can be taken from the block.
+                    extended_tx = {
+                        'height': block['height'],
+                        'timestamp': transaction['timestamp'],
+                        'leaseId': transaction['leaseId'],
+                        'lease': {'recipient': owner.generator}
+                    }
+                checkandsave_leasetransaction(routes, block, transaction, extended_tx, tx16calls)
+        # save block data
+        for tenant in receiving:
+            tenant.writebuffer.saveblock((
+                block['height'],
+                block['generator'],
+                block['totalFee'],
+                block.get('transactionCount', len(block['transactions'])),
+                block['timestamp'] // 1000,
+                tx16calls[tenant],
+                blockid(block),
+                block.get('reference')
+            ))
         
-def checkandsave_leasetransaction(conn, block, transaction, extendedtransaction):
+def checkandsave_leasetransaction(routes, block, transaction, extendedtransaction, tx16calls):
     """
-    Check block for lease and unleases
+    Check block for lease and unleases, buffering them for the tenant routes maps their
+    recipient to, and count the invokes sent by the generator of each tenant in tx16calls.
     """
 
     global config, logger
         
-    tx16calls = 0
-
-    if ('type' in transaction and transaction['type'] == TRANSACTION_TYPES['LEASE'] and (
-        transaction['recipient'] == config['waves']['generatoraddress']
-        or transaction['recipient'] == "address:" + config['waves']['generatoraddress']
-        or transaction['recipient'] == "alias:W:" + config['waves']['generatoralias']
-    )):
+    if ('type' in transaction and transaction['type'] == TRANSACTION_TYPES['LEASE'] and transaction['recipient'] in routes):
         logger.debug(f"Block {block['height']}: found a lease from {transaction['sender']}, saving, id: {transaction['id']}")
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            REPLACE INTO waves_leases (tx_id, lease_id, txtype, address, start, leasedate, end, amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                transaction['id'],
-                transaction['id'],
-                transaction['type'],
-                transaction['sender'],
-                block['height'],
-                transaction['timestamp'] // 1000,
-                None,
-                transaction['amount'],
-            ),
-        )
-        cursor.close()
+        routes[transaction['recipient']].writebuffer.savelease((
+            transaction['id'],
+            transaction['id'],
+            transaction['type'],
+            transaction['sender'],
+            block['height'],
+            transaction['timestamp'] // 1000,
+            None,
+            transaction['amount'],
+        ))
     elif 'type' in transaction and transaction['type'] == TRANSACTION_TYPES['LEASE_CANCEL']:
-        if extendedtransaction['lease']['recipient'] == config['waves']['generatoraddress']:
-            cursor = conn.cursor()
-            sql = f"""
-                UPDATE waves_leases
-                SET end = {extendedtransaction['height']},
-                    endleasedate = {extendedtransaction['timestamp'] // 1000}
-                WHERE lease_id = '{extendedtransaction['leaseId']}'
-            """
-            cursor.execute(sql)
-            if cursor.rowcount > 0:
-                logger.debug(f"Block: {extendedtransaction['height']}: Found a lease cancellation,... id: {extendedtransaction['leaseId']}")
-            cursor.close()
+        if extendedtransaction['lease']['recipient'] in routes:
+            logger.debug(f"Block: {extendedtransaction['height']}: Found a lease cancellation,... id: {extendedtransaction['leaseId']}")
+            routes[extendedtransaction['lease']['recipient']].writebuffer.cancellease((
+                extendedtransaction['height'],
+                extendedtransaction['timestamp'] // 1000,
+                extendedtransaction['leaseId'],
+            ))
 
     elif 'type' in transaction and (transaction['type'] == TRANSACTION_TYPES['INVOKE'] or 
                                   transaction['type'] == TRANSACTION_TYPES['INVOKE_SCRIPT']):
@@ -185,8 +833,8 @@ def checkandsave_leasetransaction(conn, block, transaction, extendedtransaction)
         leasecancels = []
         
         # update tx16 counter where sender is generator address
-        if transaction['sender'] == config['waves']['generatoraddress']:
-            tx16calls = tx16calls + 1            
+        if transaction['sender'] in routes:
+            tx16calls[routes[transaction['sender']]] += 1
 
         # Check recursively invokes for leases and lease cancels
         # logger.info(f"Analyzing tx {transaction['id']} type {transaction['type']}")
@@ -202,52 +850,27 @@ def checkandsave_leasetransaction(conn, block, transaction, extendedtransaction)
 
         # Save leases
         for lease in leases:
-            if (
-                lease['recipient'] == config['waves']['generatoraddress'] or
-                lease['recipient'] == "address:" + config['waves']['generatoraddress'] or
-                lease['recipient'] == "alias:W:" + config['waves']['generatoralias']
-            ):
+            if lease['recipient'] in routes:
                 logger.debug(f"Block: {extendedtransaction['height']}: Found a lease... id: {lease['id']}, saving it.")
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        """
-                        REPLACE INTO waves_leases (tx_id, lease_id, txtype, address, start, leasedate, end, amount)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        """,
-                        (
-                            transaction['id'],
-                            lease['id'],
-                            transaction['type'],
-                            lease['sender'],
-                            block['height'],
-                            transaction['timestamp'] // 1000,
-                            None,
-                            lease['amount'],
-                        )
-                    )
-                    conn.commit()
-                except sqlite3.Error as e:
-                    logger.error(f"Error saving lease: {e}")
-        # Save Cancel Lease
+                routes[lease['recipient']].writebuffer.savelease((
+                    transaction['id'],
+                    lease['id'],
+                    transaction['type'],
+                    lease['sender'],
+                    block['height'],
+                    transaction['timestamp'] // 1000,
+                    None,
+                    lease['amount'],
+                ))
+        # Save Cancel Lease, for the tenants that know the lease
         for leasecancel in leasecancels:
-            try:
-                cursor = conn.cursor()
-                cursor.execute(
-                    f"""
-                        UPDATE waves_leases
-                        SET end = {extendedtransaction['height']},
-                            endleasedate = {extendedtransaction['timestamp']//1000}
-                        WHERE lease_id = '{leasecancel['id']}'
-                    """
-                )
-                conn.commit()
-                if cursor.rowcount > 0:
-                    logger.debug(f"Block: {extendedtransaction['height']}: Found a lease cancellation... id: {leasecancel['id']}")
-            except sqlite3.Error as e:
-                logger.error(f"Error updating lease cancellation: {e}")
-    
-    return tx16calls
+            for tenant in dict.fromkeys(routes.values()):
+                if tenant.knows(leasecancel['id']):
+                    tenant.writebuffer.cancellease((
+                        extendedtransaction['height'],
+                        extendedtransaction['timestamp'] // 1000,
+                        leasecancel['id'],
+                    ))
 
 def analyzestatechanges(statechanges, leases, leasecancels):
     """
@@ -268,6 +891,39 @@ def analyzestatechanges(statechanges, leases, leasecancels):
 
 config = None
 logger = None
+knownleases = None
+tenantcache = None
+rawblockcache = None
+stopping = threading.Event()
+
+def follow(conn):
+    """
+    Keeps one process ingesting new blocks, polling the node height every
+    blocks.followinterval seconds, until SIGTERM or SIGINT. The chunk being
+    loaded is finished before stopping. The metrics are written after every poll.
+    """
+
+    interval = config.get('blocks', {}).get('followinterval', 10)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    logger.info(f"Following the chain every {interval}s")
+
+    while not stopping.is_set():
+        # every poll exports its own stage timings and counts, as a single run does
+        metrics.reset()
+        try:
+            getallblocks(conn, None, None)
+            metrics.write(config, 'blocks', True, logger)
+        except sqlite3.Error:
+            raise
+        except Exception as e:
+            # node errors are retried on the next poll
+            logger.error(f"Error while following: {e}")
+            logger.debug(traceback.format_exc())
+            metrics.write(config, 'blocks', False, logger)
+        stopping.wait(interval)
+
+    logger.info("Stopped following.")
 
 def main():
 
@@ -275,34 +931,48 @@ def main():
     logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name="blocks")
 
     if len(sys.argv) < 1:
-        print("Usage: poetry run python blocks [startblock] [endblock]")
+        print("Usage: poetry run python blocks [--replay] [startblock] [endblock] | follow")
         sys.exit(1)
 
+    following = len(sys.argv) == 2 and sys.argv[1] == 'follow'
+    replaying = len(sys.argv) > 1 and sys.argv[1] == '--replay'
+    args = sys.argv[2:] if replaying else sys.argv[1:]
+
     startblock = None
-    if len(sys.argv) > 1:
+    if len(args) > 0 and not following:
         try:
-            startblock = int(sys.argv[1])
+            startblock = int(args[0])
         except ValueError:
             logger.debug("Error: startblock must be an integer.")
             sys.exit(1)
 
     endblock = None
-    if len(sys.argv) > 2:
+    if len(args) > 1:
         try:
-            endblock = int(sys.argv[2])
+            endblock = int(args[1])
         except ValueError:
             logger.debug("Error: endblock must be an integer.")
             sys.exit(1)
 
     try:
         config = libs.load_config_from_file('config.json')
-        conn = sqlite3.connect(config['database'])  
+        libs.configure_node_client(config)
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
         logger.info("Loading Blocks");
         validate_block_range(startblock, endblock)
-        getallblocks(conn, startblock, endblock)
+        if following:
+            follow(conn)
+        elif replaying:
+            replayblocks(conn, startblock, endblock)
+        else:
+            getallblocks(conn, startblock, endblock)
+        libs.log_node_stats(logger)
+        metrics.write(config, 'blocks', True, logger)
     except Exception as e:
         logger.debug("Error: %s", e)
         logger.error(traceback.format_exc())
+        metrics.write(config, 'blocks', False, logger)
         sys.exit(1)
 
 def validate_block_range(startblock, endblock):
@@ -1,11 +1,16 @@
+import os
 import sys
 import json
-import requests
 import pywaves as pw
 import logging
 import libs
+import leasecoverage
+import ledger
+import metrics
+import migrate
 import sqlite3
 import datetime
+import concurrent.futures
 from pprint import pprint
 import traceback
 
@@ -31,6 +36,7 @@ def savepayments(config, conn, payments, blocksinfo, totals, dryrun):
                     VALUES (?, ?, ?, ?, ?, ?)
                 """
                 cursor.execute(sql, (payment_id, address, 'new', token, paymentdetails['id'], paymentdetails['reward']))
+                metrics.count('rows_written', table='waves_paymentdetails')
         if (dryrun == 'Y'):
             logger.info("Dryrun mode, rollbacking.")
             conn.rollback()
@@ -39,11 +45,9 @@ def savepayments(config, conn, payments, blocksinfo, totals, dryrun):
     except sqlite3.Error as e:
         logger.error(f"SQLLite error: {e}")
         conn.rollback()
-    finally:
-        conn.close()
 
 
-def getwavesactiveleasesatblock(height, leases_x_id):
+def getwavesactiveleasesatblock(height, leases):
     activeleasesinfo = {
         'leases': {},
         'total': 0
@@ -53,11 +57,8 @@ def getwavesactiveleasesatblock(height, leases_x_id):
     lower_bound = height - 1000
     grouped_by_address = {}
 
-    for lease in leases_x_id.values():
-        address = lease[3]
-        start = lease[4]
-        end = lease[7] if lease[7] is not None else float('inf')
-        amount = lease[8]
+    for address, start, end, amount in leasecoverage.leaserows(leases):
+        end = end if end is not None else float('inf')
         # logger.debug(f"lease: {lease}, address: {address}, start: {start}, end: {end}, amount: {amount}")
         # Check if lease fully cover [lower_bound, height]
         if start < lower_bound and height < end:
@@ -112,12 +113,10 @@ def getwavesactiveleasesatblock(height, leases_x_id):
 
     return activeleasesinfo
 
-def distribute(config, blocksinfo, balances, leases_x_id):
+def getairdroprewards(config, blocksinfo, balances):
     airdroprewards = {}
     leasersairdroprewards = {}
     nodeownerairdroprewards = {}
-    payments = {}
-    enabledtokens = {}
 
     # Check if airdrop balances are sufficient before distribution
     # if not, exit with an error
@@ -139,11 +138,22 @@ def distribute(config, blocksinfo, balances, leases_x_id):
         airdroprewards[token]=int(balances[token]['balance']/blocksinfo['minedblocks'])
         leasersairdroprewards[token]=airdroprewards[token]*(int(config['waves']['percentagetodistribute'])/100)
         nodeownerairdroprewards[token]=airdroprewards[token]-leasersairdroprewards[token]
+
+    return airdroppedtokens, leasersairdroprewards, nodeownerairdroprewards
+
+def distribute(config, blocksinfo, balances, leases, coverage=None):
+    payments = {}
+
+    airdroppedtokens, leasersairdroprewards, nodeownerairdroprewards = getairdroprewards(config, blocksinfo, balances)
     
     # calculate waves block rewards (fixed)
     previousblockinfo = blocksinfo['startblock']
     res = libs.blockchainrewards(config['waves']['node'])
     blockrewards = res['currentReward'] / 3
+
+    # sweep active leases over mined blocks only, in ascending height order
+    minedheights = [height for height, blockinfo in blocksinfo['blocks'].items() if blockinfo[1] == config['waves']['generatoraddress']]
+    activeleases = leasecoverage.activeleasesatblocks(minedheights, leasecoverage.leaserows(leases), coverage)
     
     for height, blockinfo in blocksinfo['blocks'].items():
         if blockinfo[1] != config['waves']['generatoraddress']:
@@ -159,7 +169,8 @@ def distribute(config, blocksinfo, balances, leases_x_id):
             
             # Leasers rewards
 
-            activeleasesatthisblock = getwavesactiveleasesatblock(height, leases_x_id)
+            with metrics.stage('lease_sweep'):
+                _, activeleasesatthisblock = next(activeleases)
             totalwavesshares = 0
             if len(activeleasesatthisblock['leases']) > 0:
                 for address, amountleased in activeleasesatthisblock['leases'].items():
@@ -216,33 +227,272 @@ def distribute(config, blocksinfo, balances, leases_x_id):
     return payments
 
 
-def getleasesinfo(config, conn):
-    leases_x_block = {}
-    leases_x_id = {}
+def distribute_numpy(config, blocksinfo, balances, leases, coverage=None):
+    """
+    Vectorized version of distribute: per-block shares become a (blocks x addresses)
+    matrix and waves and airdrop rewards are computed with a few array operations.
+    Integer payouts are identical to distribute.
+    """
+    import numpy as np
 
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM waves_leases")
-        rows = cursor.fetchall()
+    payments = {}
+
+    airdroppedtokens, leasersairdroprewards, nodeownerairdroprewards = getairdroprewards(config, blocksinfo, balances)
+
+    # calculate waves block rewards (fixed)
+    previousblockinfo = blocksinfo['startblock']
+    res = libs.blockchainrewards(config['waves']['node'])
+    blockrewards = res['currentReward'] / 3
+    leasersblockrewards = (blockrewards * int(config['waves']['percentagetodistribute']) / 100)
+
+    minedheights = [height for height, blockinfo in blocksinfo['blocks'].items() if blockinfo[1] == config['waves']['generatoraddress']]
+    activeleases = leasecoverage.activeleasesatblocks(minedheights, leasecoverage.leaserows(leases), coverage)
+
+    nodeownerbeneficiaryaddress = config['waves']['nodeownerbeneficiaryaddress']
+    columns = {}
+    rows = []
+    leasersblockfees = []
+
+    for height, blockinfo in blocksinfo['blocks'].items():
+        if blockinfo[1] == config['waves']['generatoraddress']:
+            blockfees = previousblockinfo[2] * 0.6 + blockinfo[2] * 0.4
+            leasersfees = (blockfees * int(config['waves']['percentagetodistribute']) / 100)
+
+            nodeownerblockfees = blockfees - leasersfees
+            nodeownerblockrewards = blockrewards - leasersblockrewards
+
+            with metrics.stage('lease_sweep'):
+                _, activeleasesatthisblock = next(activeleases)
+            if len(activeleasesatthisblock['leases']) > 0:
+                if activeleasesatthisblock['total'] == 0:
+                    raise ZeroDivisionError("Active leases total is 0 at block %d" % height)
+                for address in activeleasesatthisblock['leases']:
+                    if address not in payments:
+                        payments[address] = initpayment(airdroppedtokens)
+                        columns[address] = len(columns)
+                rows.append(activeleasesatthisblock)
+                leasersblockfees.append(leasersfees)
+
+            # Node owner rewards
+            if nodeownerbeneficiaryaddress not in payments:
+                payments[nodeownerbeneficiaryaddress] = initpayment(airdroppedtokens)
+            payments[nodeownerbeneficiaryaddress]['waves']['reward'] += int(max(0, nodeownerblockfees + nodeownerblockrewards))
+            for token in airdroppedtokens:
+                payments[nodeownerbeneficiaryaddress][token]['reward'] += int(max(0, nodeownerairdroprewards[token]))
+
+        previousblockinfo = blockinfo
+
+    if not rows:
+        return payments
+
+    # Python divides ints with correct rounding, numpy converts them to float64 first:
+    # the two only agree while amounts are exactly representable.
+    if max(row['total'] for row in rows) >= 2 ** 53:
+        logger.warning("Leased amounts exceed float64 precision, using python distribution engine.")
+        return distribute(config, blocksinfo, balances, leases, coverage)
+
+    amounts = np.zeros((len(rows), len(columns)), dtype=np.float64)
+    active = np.zeros((len(rows), len(columns)), dtype=bool)
+    totals = np.empty(len(rows), dtype=np.float64)
+    for r, row in enumerate(rows):
+        cols = [columns[address] for address in row['leases']]
+        amounts[r, cols] = list(row['leases'].values())
+        active[r, cols] = True
+        totals[r] = row['total']
+
+    shares = amounts / totals[:, None]
+
+    fees = (shares * np.array(leasersblockfees)[:, None]).astype(np.int64)
+    rewards = (shares * leasersblockrewards).astype(np.int64)
+    wavesrewards = np.maximum(0, fees + rewards).sum(axis=0)
+
+    tokenrewards = {}
+    for token in airdroppedtokens:
+        if leasersairdroprewards[token] > 0:
+            tokenrewards[token] = np.maximum(0, shares * leasersairdroprewards[token]).astype(np.int64).sum(axis=0)
+
+    # share shown for an address is the one of the last block it was active in
+    lastactive = len(rows) - 1 - np.argmax(active[::-1], axis=0)
+    lastshares = shares[lastactive, np.arange(len(columns))]
+
+    for address, c in columns.items():
+        payments[address]['waves']['share'] = float(lastshares[c])
+        payments[address]['waves']['reward'] += int(wavesrewards[c])
+        for token, tokenreward in tokenrewards.items():
+            payments[address][token]['reward'] += int(tokenreward[c])
+
+    return payments
+
+def distribute_parallel(config, blocksinfo, balances, leases, coverage=None):
+    """
+    Parallel version of distribute: the mined blocks are split into contiguous shards,
+    each one computed in a worker process with only the leases overlapping its blocks
+    and their lookback windows. Integer rewards are summed per address, so payouts
+    are identical to distribute.
+    """
+
+    payments = {}
+
+    airdroppedtokens, leasersairdroprewards, nodeownerairdroprewards = getairdroprewards(config, blocksinfo, balances)
+
+    # calculate waves block rewards (fixed)
+    previousblockinfo = blocksinfo['startblock']
+    res = libs.blockchainrewards(config['waves']['node'])
+    blockrewards = res['currentReward'] / 3
+    leasersblockrewards = (blockrewards * int(config['waves']['percentagetodistribute']) / 100)
+
+    minedblocks = []
+    for height, blockinfo in blocksinfo['blocks'].items():
+        if blockinfo[1] == config['waves']['generatoraddress']:
+            minedblocks.append((height, previousblockinfo[2] * 0.6 + blockinfo[2] * 0.4))
+        previousblockinfo = blockinfo
+
+    if not minedblocks:
+        return payments
+
+    workers = int(config['waves'].get('distributionworkers') or os.cpu_count() or 1)
+    shardsize = -(-len(minedblocks) // (workers * 4))
+    shards = []
+    for i in range(0, len(minedblocks), shardsize):
+        shardblocks = minedblocks[i:i + shardsize]
+        lower_bound = shardblocks[0][0] - leasecoverage.LOOKBACK
+        upper_bound = shardblocks[-1][0]
+        shardleases = {}
+        for address, addressleases in leases.items():
+            overlapping = [lease for lease in addressleases if lease[0] <= upper_bound and (lease[1] is None or lease[1] >= lower_bound)]
+            if overlapping:
+                shardleases[address] = overlapping
+        shardcoverage = None if coverage is None else {address: coverage[address] for address in shardleases if address in coverage}
+        shards.append((
+            shardblocks, shardleases, shardcoverage, int(config['waves']['percentagetodistribute']),
+            blockrewards, leasersblockrewards, leasersairdroprewards, nodeownerairdroprewards,
+            config['waves']['nodeownerbeneficiaryaddress']
+        ))
+
+    if workers > 1 and len(shards) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(distributeshard, shards))
+    else:
+        results = [distributeshard(shard) for shard in shards]
+
+    for result in results:
+        for address, (reward, share, tokenrewards) in result.items():
+            if address not in payments:
+                payments[address] = initpayment(airdroppedtokens)
+            payments[address]['waves']['reward'] += reward
+            if share is not None:
+                payments[address]['waves']['share'] = share
+            for token, tokenreward in tokenrewards.items():
+                payments[address][token]['reward'] += tokenreward
+
+    return payments
+
+def distributeshard(shard):
+    """
+    Worker of distribute_parallel. Returns {address: [waves reward, last share, {token: reward}]}
+    for a shard of mined blocks, with the addresses in the order they were first rewarded.
+    """
+
+    (
+        shardblocks, leases, coverage, percentage, blockrewards, leasersblockrewards,
+        leasersairdroprewards, nodeownerairdroprewards, nodeownerbeneficiaryaddress
+    ) = shard
+    nodeownerblockrewards = blockrewards - leasersblockrewards
+    rewards = {}
+
+    activeleases = leasecoverage.activeleasesatblocks([height for height, _ in shardblocks], leasecoverage.leaserows(leases), coverage)
+    for (height, blockfees), (_, activeleasesatthisblock) in zip(shardblocks, activeleases):
+        leasersblockfees = (blockfees * percentage / 100)
+        nodeownerblockfees = blockfees - leasersblockfees
+
+        for address, amountleased in activeleasesatthisblock['leases'].items():
+            if address not in rewards:
+                rewards[address] = [0, None, dict.fromkeys(leasersairdroprewards, 0)]
+            share = amountleased / activeleasesatthisblock['total']
+            rewards[address][0] += max(0, int(share * leasersblockfees) + int(share * leasersblockrewards))
+            rewards[address][1] = share
+            for token, leasersairdropreward in leasersairdroprewards.items():
+                if leasersairdropreward > 0:
+                    rewards[address][2][token] += int(max(0, (share * leasersairdropreward)))
+
+        if nodeownerbeneficiaryaddress not in rewards:
+            rewards[nodeownerbeneficiaryaddress] = [0, None, dict.fromkeys(leasersairdroprewards, 0)]
+        rewards[nodeownerbeneficiaryaddress][0] += int(max(0, nodeownerblockfees + nodeownerblockrewards))
+        for token, nodeownerairdropreward in nodeownerairdroprewards.items():
+            rewards[nodeownerbeneficiaryaddress][2][token] += int(max(0, nodeownerairdropreward))
+
+    return rewards
+
+def distribute_ledger(config, conn, blocksinfo, balances):
+    """
+    Closes the period from the reward ledger: WAVES rewards are the credits accumulated
+    at ingest time, airdrops are split over the credited per-block shares.
+    """
+
+    payments = {}
+
+    airdroppedtokens, leasersairdroprewards, nodeownerairdroprewards = getairdroprewards(config, blocksinfo, balances)
+    nodeownerbeneficiaryaddress = config['waves']['nodeownerbeneficiaryaddress']
+
+    minedheights = [height for height, blockinfo in blocksinfo['blocks'].items() if blockinfo[1] == config['waves']['generatoraddress']]
+    if not minedheights:
+        return payments
+
+    credited = set()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT height, address, reward, share FROM waves_ledger WHERE height >= ? AND height <= ? ORDER BY height",
+        (minedheights[0], minedheights[-1])
+    )
+    for height, address, reward, share in cursor:
+        if height not in blocksinfo['blocks']:
+            continue
+        credited.add(height)
+        if address not in payments:
+            payments[address] = initpayment(airdroppedtokens)
+        payments[address]['waves']['reward'] += reward
+
+        if share is not None:
+            payments[address]['waves']['share'] = share
+            for token in airdroppedtokens:
+                if leasersairdroprewards[token] > 0:
+                    payments[address][token]['reward'] += int(max(0, (share * leasersairdroprewards[token])))
+        if address == nodeownerbeneficiaryaddress:
+            for token in airdroppedtokens:
+                payments[address][token]['reward'] += int(max(0, nodeownerairdroprewards[token]))
+
+    missing = len(minedheights) - len(credited)
+    if missing:
+        raise Exception(f"The reward ledger is missing {missing} mined blocks, run: poetry run python ledger.py rebuild")
+
+    return payments
 
-        for row in rows:
-            start = row[4]
-            address = row[3]
-            lease_id = row[1]
+def initpayment(airdroppedtokens):
+    payment = {'waves': {'id': 0, 'share': 0, 'reward': 0}}
+    for token, details in airdroppedtokens.items():
+        payment[token] = {'id': details['id'], 'reward': 0}
+    return payment
 
-            if start not in leases_x_block:
-                leases_x_block[start] = {}
-            if address not in leases_x_block[start]:
-                leases_x_block[start][address] = {}
 
-            leases_x_block[start][address][lease_id] = row
-            leases_x_id[lease_id] = row
+def getcoverageinfo(config, conn, startblock, endblock):
+    """Lease coverage segments for the blocks in [startblock, endblock], see leasecoverage.loadcoverage."""
+    try:
+        return leasecoverage.loadcoverage(conn, startblock, endblock)
 
-        return leases_x_block, leases_x_id
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error: {e}")
+        raise
+
+def getleasesinfo(config, conn, startblock, endblock):
+    """Leases that can count for the blocks in [startblock, endblock], see leasecoverage.loadleases."""
+    try:
+        leases = leasecoverage.loadleases(conn, startblock, endblock)
+        metrics.process('load_leases', 'leases', sum(len(addressleases) for addressleases in leases.values()))
+        return leases
 
     except sqlite3.Error as e:
-        logger.info(f"SQLite error: {e}")
-        return None, None
+        logger.error(f"SQLite error: {e}")
+        raise
 
 
 def loadblocksinfo(config, conn):
@@ -317,14 +567,8 @@ def swap_calculate_readonly(config, asset_from, asset_to, amount):
         }
     }
     try:
-                
-        headers = {'Content-Type': 'application/json'}
-   
-        r = requests.post(config['waves']['node'] + 'utils/script/evaluate/' + config['swap']['wx_contract_address'], data=json.dumps(data), headers=headers)
-        
-        r.raise_for_status()
-        result = r.json()     
-        if 'result' in result:
+        result = libs.wrapper(config['waves']['node'], 'utils/script/evaluate/' + config['swap']['wx_contract_address'], postData=json.dumps(data))
+        if result is not None and 'result' in result:
             return result
         else:
             logger.error(f"Contract error: {json.dumps(result, indent=2)}")
@@ -357,6 +601,148 @@ def swap_execute(config, asset_from, asset_to, amount, amount_out_min):
         return None
     
 
+def calculate(config, conn, addr, swapunit0, dryrun):
+    """
+    Calculates the payments of the blocks mined since the last payment and saves them
+    locked (paymentlock = 'Y') for sendpayments. Exits if the last payment is still locked.
+    Returns the balances of addr the payments were checked against.
+    """
+
+    logger.info("---------------------------------------")
+    logger.info(f"Operating from address: {addr.address}")
+
+    # Check if last payment had an error
+    cursor = conn.cursor()
+    cursor.execute("SELECT paymentlock FROM waves_payments ORDER BY id DESC LIMIT 1")
+    result = cursor.fetchone()
+
+    if result:  # If there is at least one payment
+        payment_lock = result[0]
+        if payment_lock == 'Y':
+            logger.error("Error: Last payment is locked (paymentlock = 'Y').")
+            cursor.close()
+            sys.exit(1)
+
+    # Get node balances
+    with metrics.stage('balances'):
+        balances = libs.get_balances(config, addr)
+    
+    # Load info from blocks
+    with metrics.stage('load_blocks'):
+        blocksinfo = loadblocksinfo(config, conn)
+
+    logger.info(f"Start block: {blocksinfo['startblock']}")
+    logger.info(f"End block: {blocksinfo['endblock']}")
+    logger.info(f"Mined blocks: {blocksinfo['minedblocks']}")
+    logger.info(f"Percentage distributed: {config['waves']['percentagetodistribute']}%");
+    logger.debug(f"Total tx16calls: {blocksinfo['tx16calls']}, debt: {blocksinfo['nodetx16debt']/10**8}")
+    
+    if blocksinfo['minedblocks'] == 0:
+        logger.warning(f"No blocks were mined, exiting.")
+        sys.exit(1)
+
+    # swap unit0 to waves for canceling debt
+
+    if swapunit0 == 'Y' and blocksinfo['nodetx16debt'] > 0:
+        logger.info("Swapping Unit0 to WAVES")
+        calc_unit0_price = swap_calculate_readonly(config,config['swap']['unit0_asset_id'], config['swap']['waves_asset_id'], 10**8)            
+        unit0_price_inwaves = calc_unit0_price["result"]["value"]["_2"]["value"]
+        logger.info(f"Unit0 price in waves: {unit0_price_inwaves/10**8}")                             
+        logger.info(f"My Unit0 balance: {balances['unit0']['balance']/10**8}")
+        unit0toswap = int(blocksinfo['nodetx16debt'] * 1.05/ unit0_price_inwaves * 10 ** 8)
+        logger.info(f"Unit0 to swap: {unit0toswap/10**8}") 
+        if dryrun == 'N':
+            tx = swap_execute(config, config['swap']['unit0_asset_id'], config['swap']['waves_asset_id'], int(unit0toswap), int(blocksinfo['nodetx16debt']))            
+            if (tx is not None):
+                logger.info("Unit0 swapped to WAVES")
+            else:
+                logger.error("Error: Unit0 swap failed, exiting.")
+                sys.exit(1)
+            # refresh balances
+            libs.invalidate_balances(addr.address)
+            balances = libs.get_balances(config, addr)
+    else:
+        logger.info("Not swapping Unit0 to WAVES")
+    
+
+    # Load leases info
+    if not ledger.enabled(config):
+        with metrics.stage('load_leases'):
+            coverage = getcoverageinfo(config, conn, blocksinfo['startblock'], blocksinfo['endblock'])
+            leases = getleasesinfo(config, conn, blocksinfo['startblock'], blocksinfo['endblock'])
+
+    # distribute payments
+    payments = {}
+    with metrics.stage('distribute'):
+        if ledger.enabled(config):
+            payments = distribute_ledger(config, conn, blocksinfo, balances)
+        elif config['waves'].get('distributionengine', 'python') == 'parallel':
+            payments = distribute_parallel(config, blocksinfo, balances, leases, coverage)
+        elif config['waves'].get('distributionengine', 'python') == 'numpy':
+            payments = distribute_numpy(config, blocksinfo, balances, leases, coverage)
+        else:
+            payments = distribute(config, blocksinfo, balances, leases, coverage)
+    metrics.process('distribute', 'blocks', blocksinfo['minedblocks'])
+    metrics.process('distribute', 'addresses', len(payments))
+    metrics.process('lease_sweep', 'blocks', blocksinfo['minedblocks'])
+    
+    # foreach payments, remove entries with amount 0 and removesending fees
+    for address, tokens in list(payments.items()):
+        for token, paymentdetails in list(tokens.items()):
+            if paymentdetails['reward'] <= 0:
+                del tokens[token]
+        if not tokens:
+            del payments[address]
+
+    for address, tokens in payments.items():
+        if 'waves' in tokens:
+            n = len(tokens)
+            tokens['waves']['reward'] = max(0, tokens['waves']['reward'] - (0.001 * 10 ** 8 * n))
+
+    # check node balance vs amount to be sent
+    totals = {}
+    
+    logger.debug("-------------------- Payments --------------------")
+    for address, tokens in payments.items():
+        if (address == config['waves']['nodeownerbeneficiaryaddress']):
+            line = f"{address} (node owner),"
+        else:
+            line = f"{address},"
+        for token, paymentdetails in tokens.items():
+            if token in totals:
+                totals[token] += int(paymentdetails['reward'])
+            else:
+                totals[token] = int(paymentdetails['reward'])
+            if (token == 'waves'):
+                line += f"{token}:{paymentdetails['reward'] / 10 ** 8:.8f},share:{paymentdetails['share'] * 100:.2f}%,"
+            else:
+                line += f"{token}:{paymentdetails['reward'] / 10 ** config['waves']['airdrops'][token]['decimals']:.8f},"
+        logger.debug(line)
+    logger.debug("--------------------------------")
+
+    totalwavesneeded = int(totals['waves'])
+    for token, amount in totals.items():
+        if token == 'waves':
+            logger.info(f"Total {token} to be sent: {amount / 10 ** 8:.8f}")
+        else:
+            logger.info(f"Total {token} to be sent: {amount / 10 ** config['waves']['airdrops'][token]['decimals']:.8f}")
+
+    logger.info(f"Node Balance: {balances['waves']['balance'] / 10 ** 8} WAVES")
+    logger.info(f"Total waves needed: {totalwavesneeded / 10 ** 8}")
+    
+    if (totals['waves']) > balances['waves']['balance']:
+        logger.info(f"Node debt: {(balances['waves']['balance'] - totalwavesneeded) / 10 ** 8}")
+        logger.error("Not enough balance: add waves to node balance, exiting.")
+        #sys.exit(1)
+        
+    with metrics.stage('save_payments'):
+        savepayments(config, conn, payments, blocksinfo, totals, dryrun)
+    if (dryrun == 'N'):
+        logger.info("Calculated payments, you can now launch sendpayments.")
+    else:
+        logger.info("Calculated payments, no payments were saved.")
+    return balances
+
 def main():
     global logger
 
@@ -364,6 +750,9 @@ def main():
         print("Usage: poetry run python calculatepayments.py [swapunit0 Y|N] [dryrun Y|N]")
         sys.exit(1)
 
+    config = None
+    success = False
+
     try:
 
         logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name="calculatepayments")
@@ -371,131 +760,22 @@ def main():
         dryrun = sys.argv[2]
         
         config = libs.load_config_from_file('config.json')
-        conn = sqlite3.connect(config['database'])  # Use the database filename from config
+        libs.configure_node_client(config)
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
         pw.setNode(config['waves']['node'], config['waves']['chain'])
         addr = pw.address.Address(privateKey=config['waves']['pk'])
         
-        logger.info("---------------------------------------")
-        logger.info(f"Operating from address: {addr.address}")
-
-        # Check if last payment had an error
-        cursor = conn.cursor()
-        cursor.execute("SELECT paymentlock FROM waves_payments ORDER BY id DESC LIMIT 1")
-        result = cursor.fetchone()
-
-        if result:  # If there is at least one payment
-            payment_lock = result[0]
-            if payment_lock == 'Y':
-                logger.error("Error: Last payment is locked (paymentlock = 'Y').")
-                cursor.close()
-                conn.close()
-                sys.exit(1)
-
-        # Get node balances
-        balances = libs.get_balances(config, addr)
-        
-        # Load info from blocks
-        blocksinfo = loadblocksinfo(config, conn)
-
-        logger.info(f"Start block: {blocksinfo['startblock']}")
-        logger.info(f"End block: {blocksinfo['endblock']}")
-        logger.info(f"Mined blocks: {blocksinfo['minedblocks']}")
-        logger.info(f"Percentage distributed: {config['waves']['percentagetodistribute']}%");
-        logger.debug(f"Total tx16calls: {blocksinfo['tx16calls']}, debt: {blocksinfo['nodetx16debt']/10**8}")
-        
-        if blocksinfo['minedblocks'] == 0:
-            logger.warning(f"No blocks were mined, exiting.")
-            sys.exit(1)
-
-        # swap unit0 to waves for canceling debt
-
-        if swapunit0 == 'Y' and blocksinfo['nodetx16debt'] > 0:
-            logger.info("Swapping Unit0 to WAVES")
-            calc_unit0_price = swap_calculate_readonly(config,config['swap']['unit0_asset_id'], config['swap']['waves_asset_id'], 10**8)            
-            unit0_price_inwaves = calc_unit0_price["result"]["value"]["_2"]["value"]
-            logger.info(f"Unit0 price in waves: {unit0_price_inwaves/10**8}")                             
-            logger.info(f"My Unit0 balance: {balances['unit0']['balance']/10**8}")
-            unit0toswap = int(blocksinfo['nodetx16debt'] * 1.05/ unit0_price_inwaves * 10 ** 8)
-            logger.info(f"Unit0 to swap: {unit0toswap/10**8}") 
-            if dryrun == 'N':
-                tx = swap_execute(config, config['swap']['unit0_asset_id'], config['swap']['waves_asset_id'], int(unit0toswap), int(blocksinfo['nodetx16debt']))            
-                if (tx is not None):
-                    logger.info("Unit0 swapped to WAVES")
-                else:
-                    logger.error("Error: Unit0 swap failed, exiting.")
-                    sys.exit(1)
-                # refresh balances
-                balances = libs.get_balances(config, addr)
-        else:
-            logger.info("Not swapping Unit0 to WAVES")
-        
-
-        # Load leases info
-        leases_x_block, leases_x_id = getleasesinfo(config, conn)
-
-        # distribute payments
-        payments = {}
-        payments = distribute(config, blocksinfo, balances, leases_x_id)
-        
-        # foreach payments, remove entries with amount 0 and removesending fees
-        for address, tokens in list(payments.items()):
-            for token, paymentdetails in list(tokens.items()):
-                if paymentdetails['reward'] <= 0:
-                    del tokens[token]
-            if not tokens:
-                del payments[address]
-
-        for address, tokens in payments.items():
-            if 'waves' in tokens:
-                n = len(tokens)
-                tokens['waves']['reward'] = max(0, tokens['waves']['reward'] - (0.001 * 10 ** 8 * n))
-
-        # check node balance vs amount to be sent
-        totals = {}
-        
-        logger.debug("-------------------- Payments --------------------")
-        for address, tokens in payments.items():
-            if (address == config['waves']['nodeownerbeneficiaryaddress']):
-                line = f"{address} (node owner),"
-            else:
-                line = f"{address},"
-            for token, paymentdetails in tokens.items():
-                if token in totals:
-                    totals[token] += int(paymentdetails['reward'])
-                else:
-                    totals[token] = int(paymentdetails['reward'])
-                if (token == 'waves'):
-                    line += f"{token}:{paymentdetails['reward'] / 10 ** 8:.8f},share:{paymentdetails['share'] * 100:.2f}%,"
-                else:
-                    line += f"{token}:{paymentdetails['reward'] / 10 ** config['waves']['airdrops'][token]['decimals']:.8f},"
-            logger.debug(line)
-        logger.debug("--------------------------------")
-
-        totalwavesneeded = int(totals['waves'])
-        for token, amount in totals.items():
-            if token == 'waves':
-                logger.info(f"Total {token} to be sent: {amount / 10 ** 8:.8f}")
-            else:
-                logger.info(f"Total {token} to be sent: {amount / 10 ** config['waves']['airdrops'][token]['decimals']:.8f}")
-
-        logger.info(f"Node Balance: {balances['waves']['balance'] / 10 ** 8} WAVES")
-        logger.info(f"Total waves needed: {totalwavesneeded / 10 ** 8}")
-        
-        if (totals['waves']) > balances['waves']['balance']:
-            logger.info(f"Node debt: {(balances['waves']['balance'] - totalwavesneeded) / 10 ** 8}")
-            logger.error("Not enough balance: add waves to node balance, exiting.")
-            #sys.exit(1)
-            
-        savepayments(config, conn, payments, blocksinfo, totals, dryrun)
-        if (dryrun == 'N'):
-            logger.info("Calculated payments, you can now launch sendpayments.")
-        else:
-            logger.info("Calculated payments, no payments were saved.")
+        calculate(config, conn, addr, swapunit0, dryrun)
+        conn.close()
+        success = True
             
     except Exception as e:
         logger.error(f"Error: {e}")
         logger.error(traceback.format_exc())
         sys.exit(1)
+    finally:
+        metrics.write(config, 'calculatepayments', success, logger)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,191 @@
+import sys
+import argparse
+
+# Modules are imported by the commands that use them, so that --help and the
+# read-only commands start without loading pywaves and requests.
+
+def setup(args, logger):
+    """
+    Loads the config and opens the database. The database of a read-only command is
+    neither created nor migrated: it must exist with an up to date schema.
+    """
+    import libs
+    import migrate
+
+    config = libs.load_config_from_file(args.config)
+    libs.configure_node_client(config)
+    if args.readonly:
+        conn = libs.connect_db(config, readonly=True)
+        pending = migrate.pendingversions(conn)
+        if pending:
+            conn.close()
+            raise Exception(f"The schema of {config['database']} is out of date, run: poetry run python migrate.py")
+    else:
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
+    return config, conn
+
+def wallet(config):
+    """Returns the pywaves address of the configured private key."""
+    import pywaves as pw
+
+    pw.setNode(config['waves']['node'], config['waves']['chain'])
+    return pw.address.Address(privateKey=config['waves']['pk'])
+
+def sync(args, config, logger, conn):
+    import blocks
+
+    blocks.config = config
+    blocks.logger = logger
+    blocks.validate_block_range(args.startblock, args.endblock)
+    if args.replay:
+        blocks.replayblocks(conn, args.startblock, args.endblock)
+    else:
+        blocks.getallblocks(conn, args.startblock, args.endblock)
+
+def backfill(args, config, logger, conn):
+    import blocks
+    import backfill
+
+    blocks.config = backfill.config = config
+    blocks.logger = backfill.logger = logger
+    blocks.validate_block_range(args.startblock, args.endblock)
+    startblock, endblock = backfill.defaultrange(conn, args.startblock, args.endblock)
+    if startblock > endblock:
+        logger.info("No blocks to backfill.")
+        return
+    logger.info(f"Backfilled {backfill.backfill(conn, startblock, endblock)} blocks.")
+
+def follow(args, config, logger, conn):
+    import blocks
+
+    blocks.config = config
+    blocks.logger = logger
+    blocks.follow(conn)
+
+def calculate(args, config, logger, conn, addr=None):
+    import calculatepayments
+
+    calculatepayments.logger = logger
+    return calculatepayments.calculate(config, conn, addr or wallet(config), yesno(args.swapunit0), yesno(args.dryrun))
+
+def pay(args, config, logger, conn, addr=None, balances=None):
+    import sendpayments
+
+    sendpayments.logger = logger
+    addr = addr or wallet(config)
+    logger.info(f"Operating from address {addr.address}")
+    if not sendpayments.pay(config, conn, addr, yesno(args.dryrun), balances):
+        raise Exception("Some errors occurred while paying, run it again to resume the payment.")
+
+def run(args, config, logger, conn):
+    """
+    Syncs blocks, calculates and sends the payment in one process, sharing the node
+    client, the database connection, the address and the balances between stages.
+    """
+
+    import libs
+
+    args.startblock = args.endblock = None
+    args.replay = False
+    sync(args, config, logger, conn)
+    libs.log_node_stats(logger)
+
+    addr = wallet(config)
+    balances = calculate(args, config, logger, conn, addr)
+    if args.dryrun:
+        logger.info("Dryrun mode, the payment was not saved, not paying.")
+        return
+    pay(args, config, logger, conn, addr, balances)
+    logger.info("Payment has been succesfully completed.")
+
+def status(args, config, logger, conn):
+    row = conn.execute("SELECT MAX(height) FROM waves_blocks").fetchone()
+    print(f"Last block: {row[0]}")
+    row = conn.execute("SELECT id, startblock, endblock, minedblocks, paymentlock, timestamp FROM waves_payments ORDER BY id DESC LIMIT 1").fetchone()
+    if row is None:
+        print("No payments.")
+        return
+    print(f"Last payment: #{row[0]}, blocks {row[1]}-{row[2]}, {row[3]} mined, {row[5]}{', locked' if row[4] == 'Y' else ''}")
+    for token, status, count, amount in conn.execute(
+        "SELECT token, status, COUNT(*), SUM(amount) FROM waves_paymentdetails WHERE payment_id = ? GROUP BY token, status ORDER BY token, status", (row[0],)
+    ):
+        print(f"  {token} {status}: {count} payments, {amount}")
+
+def accrued(args, config, logger, conn):
+    import ledger
+
+    row = conn.execute("SELECT MAX(endblock) FROM waves_payments").fetchone()
+    startblock = (row[0] or 0) + 1
+    endblock = conn.execute("SELECT MAX(height) FROM waves_blocks").fetchone()[0] or 0
+    for address, (reward, blocks) in ledger.accrued(conn, startblock, endblock).items():
+        print(f"{address}: {reward / 10 ** 8:.8f} WAVES accrued over {blocks} blocks")
+
+def yesno(flag):
+    return 'Y' if flag else 'N'
+
+def parser():
+    parser = argparse.ArgumentParser(prog='l0ps', description="L0 WAVES payment script")
+    parser.add_argument('--config', default='config.json', help="configuration file (default: config.json)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('sync', help="load blocks and leases from the node")
+    command.add_argument('--replay', action='store_true', help="rebuild from the raw block cache, without a node")
+    command.add_argument('startblock', type=int, nargs='?')
+    command.add_argument('endblock', type=int, nargs='?')
+    command.set_defaults(func=sync, job='blocks', readonly=False)
+
+    command = commands.add_parser('backfill', help="load a large range of blocks with worker processes, resumable")
+    command.add_argument('startblock', type=int, nargs='?')
+    command.add_argument('endblock', type=int, nargs='?')
+    command.set_defaults(func=backfill, job='backfill', readonly=False)
+
+    command = commands.add_parser('follow', help="keep loading new blocks until stopped")
+    command.set_defaults(func=follow, job='blocks', readonly=False)
+
+    for name, func, job, help in (
+        ('calculate', calculate, 'calculatepayments', "calculate the payment of the blocks mined since the last one"),
+        ('pay', pay, 'sendpayments', "send the locked payment"),
+        ('run', run, 'run', "sync, calculate and pay in one process")
+    ):
+        command = commands.add_parser(name, help=help)
+        if name != 'pay':
+            command.add_argument('--swapunit0', action='store_true', help="swap Unit0 to WAVES to cancel the node debt")
+        command.add_argument('--dryrun', action='store_true', help="do not save or send anything")
+        command.set_defaults(func=func, job=job, readonly=False)
+
+    command = commands.add_parser('status', help="show the last block and payment")
+    command.set_defaults(func=status, job=None, readonly=True)
+
+    command = commands.add_parser('accrued', help="show the rewards accrued in the ledger since the last payment")
+    command.set_defaults(func=accrued, job=None, readonly=True)
+
+    return parser
+
+def main(argv=None):
+
+    args = parser().parse_args(argv)
+
+    import logging
+    import traceback
+    import libs
+    import metrics
+
+    config = None
+    success = False
+    logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name='l0ps' if args.readonly else args.job)
+    try:
+        config, conn = setup(args, logger)
+        args.func(args, config, logger, conn)
+        conn.close()
+        success = True
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        if args.job:
+            metrics.write(config, args.job, success, logger)
+
+if __name__ == "__main__":
+    main()
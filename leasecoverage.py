@@ -0,0 +1,187 @@
+from bisect import bisect_left, bisect_right
+
+# A lease counts for a mined block only if it covers the previous LOOKBACK blocks.
+LOOKBACK = 1000
+
+INF = float('inf')
+
+# Coverage segments spanning [height - LOOKBACK, height] for some height in a range
+SQL_COVERAGE = """
+    SELECT address, covered_from, covered_to
+    FROM waves_lease_coverage
+    WHERE covered_from <= ?
+    AND (covered_to IS NULL OR (covered_to >= ? AND covered_to - covered_from >= ?))
+"""
+
+SQL_LEASES = f"""
+    SELECT address, start, end, amount
+    FROM waves_leases
+    WHERE start <= ?
+    AND (end IS NULL OR end >= ?)
+    AND address IN (SELECT address FROM ({SQL_COVERAGE}))
+"""
+
+def loadcoverage(conn, startblock, endblock):
+    """
+    Loads the lease coverage segments that cover a whole lookback window for at least
+    one block in [startblock, endblock]. Returns {address: [(covered_from, covered_to), ...]}.
+    """
+    coverage = {}
+    for address, covered_from, covered_to in conn.execute(SQL_COVERAGE, (endblock - LOOKBACK, startblock, LOOKBACK)):
+        if address not in coverage:
+            coverage[address] = []
+        coverage[address].append((covered_from, covered_to))
+    return coverage
+
+def loadleases(conn, startblock, endblock):
+    """
+    Loads the leases that can count for blocks in [startblock, endblock]: the ones
+    starting before endblock and still open or ending inside the lookback window,
+    of the addresses whose lease coverage spans a lookback window in the range.
+    Returns {address: [(start, end, amount), ...]}.
+    """
+    leases = {}
+    for address, start, end, amount in conn.execute(SQL_LEASES, (endblock, startblock - LOOKBACK, endblock - LOOKBACK, startblock, LOOKBACK)):
+        if address not in leases:
+            leases[address] = []
+        leases[address].append((start, end, amount))
+    return leases
+
+def leaserows(leases):
+    """
+    Flattens {address: [(start, end, amount), ...]} into (address, start, end, amount) tuples.
+    """
+    for address, addressleases in leases.items():
+        for start, end, amount in addressleases:
+            yield address, start, end, amount
+
+def activeleasesatblocks(heights, leases, coverage=None):
+    """
+    Sweep-line equivalent of calculatepayments.getwavesactiveleasesatblock.
+
+    Args:
+        heights: block heights to evaluate, in ascending order
+        leases: iterable of (address, start, end, amount) tuples, end is None while the lease is active
+        coverage: optional {address: [(covered_from, covered_to), ...]} merged lease segments,
+            as stored in waves_lease_coverage. Only the addresses with a segment covering
+            the whole lookback window are checked for partial cover.
+
+    Yields:
+        (height, activeleasesinfo) for every height, with the same per-address
+        amounts and total as the full-scan implementation.
+    """
+
+    leases = [(address, start, end if end is not None else INF, amount) for address, start, end, amount in leases]
+
+    # Full cover: start < height - LOOKBACK and height < end,
+    # i.e. the lease enters at start + LOOKBACK + 1 and leaves at end.
+    entering = sorted((start + LOOKBACK + 1, i) for i, (address, start, end, amount) in enumerate(leases) if end > start + LOOKBACK + 1)
+    leaving = sorted((leases[i][2], i) for _, i in entering if leases[i][2] != INF)
+
+    # Interval index for the leases that only partially intersect the lookback window.
+    bystart = sorted((start, i) for i, (address, start, end, amount) in enumerate(leases))
+    starts = [start for start, _ in bystart]
+    byend = sorted((end, i) for i, (address, start, end, amount) in enumerate(leases) if end != INF)
+    ends = [end for end, _ in byend]
+
+    # An address can only be active while one of its segments covers [height - LOOKBACK, height]
+    if coverage is not None:
+        coveringfrom = sorted((start + LOOKBACK, address) for address, segments in coverage.items() for start, end in segments if end is None or end >= start + LOOKBACK)
+        coveringto = sorted((end + 1, address) for address, segments in coverage.items() for start, end in segments if end is not None and end >= start + LOOKBACK)
+    covering = {}
+    cf = 0
+    ct = 0
+
+    fullamount = {}
+    fullcount = {}
+    fulltotal = 0
+    e = 0
+    l = 0
+    previousheight = None
+
+    for height in heights:
+        if previousheight is not None and height < previousheight:
+            raise ValueError("heights must be in ascending order")
+        previousheight = height
+        lower_bound = height - LOOKBACK
+
+        while e < len(entering) and entering[e][0] <= height:
+            address, start, end, amount = leases[entering[e][1]]
+            fullamount[address] = fullamount.get(address, 0) + amount
+            fullcount[address] = fullcount.get(address, 0) + 1
+            fulltotal += amount
+            e += 1
+
+        while l < len(leaving) and leaving[l][0] <= height:
+            address, start, end, amount = leases[leaving[l][1]]
+            fullamount[address] -= amount
+            fullcount[address] -= 1
+            fulltotal -= amount
+            if fullcount[address] == 0:
+                del fullamount[address]
+                del fullcount[address]
+            l += 1
+
+        # Candidates start or end inside [lower_bound, height]
+        candidates = set(i for _, i in bystart[bisect_left(starts, lower_bound):bisect_right(starts, height)])
+        candidates.update(i for _, i in byend[bisect_left(ends, lower_bound):bisect_right(ends, height)])
+
+        if coverage is not None:
+            while cf < len(coveringfrom) and coveringfrom[cf][0] <= height:
+                covering[coveringfrom[cf][1]] = covering.get(coveringfrom[cf][1], 0) + 1
+                cf += 1
+            while ct < len(coveringto) and coveringto[ct][0] <= height:
+                covering[coveringto[ct][1]] -= 1
+                if covering[coveringto[ct][1]] == 0:
+                    del covering[coveringto[ct][1]]
+                ct += 1
+
+        grouped_by_address = {}
+        for i in sorted(candidates):
+            address, start, end, amount = leases[i]
+            if coverage is not None and address not in covering:
+                continue
+            if start < lower_bound and height < end:
+                continue
+            if end < lower_bound or start > height:
+                continue
+            if address not in grouped_by_address:
+                grouped_by_address[address] = []
+            grouped_by_address[address].append((start, end, amount))
+
+        activeleasesinfo = {
+            'leases': dict(fullamount),
+            'total': fulltotal
+        }
+
+        for address, addressleases in grouped_by_address.items():
+            min_amount = coveredamount(addressleases, lower_bound, height)
+            if min_amount is not None:
+                activeleasesinfo['leases'][address] = activeleasesinfo['leases'].get(address, 0) + min_amount
+                activeleasesinfo['total'] += min_amount
+
+        yield height, activeleasesinfo
+
+def coveredamount(leases, lower_bound, height):
+    """
+    Returns the minimum amount of leases if together they cover [lower_bound, height], None otherwise.
+    """
+
+    intervals = []
+    min_amount = INF
+
+    for start, end, amount in leases:
+        intervals.append((max(start, lower_bound), min(end, height)))
+        min_amount = min(min_amount, amount)
+
+    intervals.sort()
+    current = lower_bound
+
+    for start, end in intervals:
+        if start > current:
+            return None
+        current = max(current, end)
+
+    if current >= height:
+        return min_amount
+    return None
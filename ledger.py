@@ -0,0 +1,139 @@
+import sys
+import logging
+import traceback
+import libs
+import leasecoverage
+import metrics
+import migrate
+
+# Leaser and node owner credits of the same block and address add up,
+# share stays NULL for node owner credits.
+SQL_CREDIT = """
+    INSERT INTO waves_ledger (height, address, reward, share)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (height, address) DO UPDATE SET
+        reward = reward + excluded.reward,
+        share = CASE WHEN excluded.share IS NULL THEN share ELSE COALESCE(share, 0) + excluded.share END
+"""
+
+def enabled(config):
+    return bool(config['waves'].get('ledger', False))
+
+def blockrewards(config):
+    """Returns the WAVES reward of a block, as distributed over the fee/reward split."""
+    res = libs.blockchainrewards(config['waves']['node'])
+    if res is None:
+        raise Exception("Could not fetch the block reward for the reward ledger.")
+    return res['currentReward'] / 3
+
+def credit(config, conn, startblock, endblock, logger):
+    """
+    Credits the WAVES fee and reward shares of the blocks mined in [startblock, endblock]
+    to waves_ledger, with the same 60/40 fee split and percentagetodistribute as
+    calculatepayments.distribute. Blocks and leases up to endblock must be saved.
+    Returns the number of credited blocks.
+    """
+
+    generator = config['waves']['generatoraddress']
+    nodeownerbeneficiaryaddress = config['waves']['nodeownerbeneficiaryaddress']
+    percentage = int(config['waves']['percentagetodistribute'])
+
+    previousfees = None
+    mined = []
+    for height, blockgenerator, fees in conn.execute(
+        "SELECT height, generator, fees FROM waves_blocks WHERE height >= ? AND height <= ? ORDER BY height", (startblock - 1, endblock)
+    ):
+        if height >= startblock and blockgenerator == generator:
+            mined.append((height, previousfees or 0, fees))
+        previousfees = fees
+
+    if not mined:
+        return 0
+
+    rewards = blockrewards(config)
+    leasersblockrewards = (rewards * percentage / 100)
+    nodeownerblockrewards = rewards - leasersblockrewards
+
+    leases = leasecoverage.loadleases(conn, mined[0][0], mined[-1][0])
+    coverage = leasecoverage.loadcoverage(conn, mined[0][0], mined[-1][0])
+    activeleases = leasecoverage.activeleasesatblocks([height for height, _, _ in mined], leasecoverage.leaserows(leases), coverage)
+
+    credits = []
+    for (height, previousfees, fees), (_, activeleasesatthisblock) in zip(mined, activeleases):
+        blockfees = previousfees * 0.6 + fees * 0.4
+        leasersblockfees = (blockfees * percentage / 100)
+        nodeownerblockfees = blockfees - leasersblockfees
+
+        for address, amountleased in activeleasesatthisblock['leases'].items():
+            share = amountleased / activeleasesatthisblock['total']
+            leaserfees = int(share * leasersblockfees)
+            leaserrewards = int(share * leasersblockrewards)
+            credits.append((height, address, max(0, leaserfees + leaserrewards), share))
+
+        credits.append((height, nodeownerbeneficiaryaddress, int(max(0, nodeownerblockfees + nodeownerblockrewards)), None))
+
+    with conn:
+        conn.execute("DELETE FROM waves_ledger WHERE height >= ? AND height <= ?", (startblock, endblock))
+        conn.executemany(SQL_CREDIT, credits)
+    metrics.count('rows_written', len(credits), table='waves_ledger')
+
+    logger.debug(f"Credited {len(mined)} mined blocks between {startblock} and {endblock} to the reward ledger")
+    return len(mined)
+
+def rollback(conn, height):
+    """Removes the credits of the blocks from height onwards."""
+    conn.execute("DELETE FROM waves_ledger WHERE height >= ?", (height,))
+
+def accrued(conn, startblock, endblock):
+    """
+    Returns {address: (reward, blocks)} credited for the blocks in [startblock, endblock].
+    """
+
+    return {
+        address: (reward, blocks) for address, reward, blocks in conn.execute(
+            "SELECT address, SUM(reward), COUNT(*) FROM waves_ledger WHERE height >= ? AND height <= ? GROUP BY address ORDER BY address",
+            (startblock, endblock)
+        )
+    }
+
+def main():
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('rebuild', 'accrued') or len(sys.argv) > 4:
+        print("Usage: poetry run python ledger.py rebuild [startblock] [endblock] | accrued")
+        sys.exit(1)
+
+    try:
+        logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name="ledger")
+        config = libs.load_config_from_file('config.json')
+        libs.configure_node_client(config)
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
+
+        # by default, the blocks after the last payment
+        row = conn.execute("SELECT MAX(endblock) FROM waves_payments").fetchone()
+        startblock = row[0] if row[0] is not None else conn.execute("SELECT MIN(height) FROM waves_blocks").fetchone()[0]
+        endblock = conn.execute("SELECT MAX(height) FROM waves_blocks").fetchone()[0]
+        if startblock is None:
+            logger.error("Error: waves_blocks table is empty.")
+            sys.exit(1)
+
+        if sys.argv[1] == 'rebuild':
+            if len(sys.argv) > 2:
+                startblock = int(sys.argv[2])
+            if len(sys.argv) > 3:
+                endblock = int(sys.argv[3])
+            credited = 0
+            for blockrange in range(startblock, endblock + 1, 1000):
+                credited += credit(config, conn, blockrange, min(blockrange + 999, endblock), logger)
+            logger.info(f"Credited {credited} mined blocks between {startblock} and {endblock}.")
+        else:
+            for address, (reward, blocks) in accrued(conn, startblock + 1, endblock).items():
+                logger.info(f"{address}: {reward / 10 ** 8:.8f} WAVES accrued over {blocks} blocks")
+        conn.close()
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,87 @@
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import itertools
 import logging
 import os
-import requests
 import json
+import pathlib
+import re
+import sqlite3
 import sys
+import threading
+import time
+
+# orjson decodes node responses faster when it is installed
+try:
+    import orjson
+    jsonloads = orjson.loads
+except ImportError:
+    jsonloads = json.loads
+
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_DECODER = json.JSONDecoder()
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+JSON_NUMBER_END = re.compile(r'[\s,\]]')
 
 def height(host):
+    if isinstance(host, NodePool):
+        return host.height()
     res = wrapper(host, '/blocks/height')
     if res is not None:
         return res['height']
     return None
 
+# Balances of our own addresses: (address, asset ids) -> (fetched at, balances)
+balancecache = {}
+
 def get_balances(config, addr):
+    """
+    Returns the WAVES and enabled airdrop token balances of addr, with one request for
+    WAVES and one for all the assets. Balances are cached for waves.balancecachettl
+    seconds, invalidate_balances must be called after sending or swapping from addr.
+    """
+
+    node = config['waves']['node']
+    tokens = {token: details for token, details in config['waves']['airdrops'].items() if details['enabled']}
+    key = (addr.address, tuple(details['assetid'] for details in tokens.values()))
+    cached = balancecache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < config['waves'].get('balancecachettl', 10):
+        return {token: dict(balance) for token, balance in cached[1].items()}
+
+    res = wrapper(node, f"/addresses/balance/{addr.address}")
+    if not isinstance(res, dict) or 'balance' not in res:
+        raise Exception(f"Failed to fetch the WAVES balance of {addr.address}: {res}")
     balances = {}
     balances['waves'] = {
-        'balance':addr.balance(),
+        'balance':res['balance'],
         'assetid':None,
         'decimals':8
     }
-    for token, details in config['waves']['airdrops'].items():
-        if details['enabled']:
+
+    if tokens:
+        query = '&'.join(f"id={details['assetid']}" for details in tokens.values())
+        res = wrapper(node, f"/assets/balance/{addr.address}?{query}")
+        if not isinstance(res, dict) or 'balances' not in res:
+            raise Exception(f"Failed to fetch the asset balances of {addr.address}: {res}")
+        assetbalances = {balance['assetId']: balance['balance'] for balance in res['balances']}
+        for token, details in tokens.items():
             balances[token] = {
-                'balance':addr.balance(assetId=details['assetid']),
+                'balance':assetbalances.get(details['assetid'], 0),
                 'assetid':details['assetid'],
                 'decimals':details['decimals']
             }
 
+    balancecache[key] = (time.monotonic(), {token: dict(balance) for token, balance in balances.items()})
     return balances
 
+def invalidate_balances(address=None):
+    """Drops the cached balances of address, or of all the addresses."""
+    for key in list(balancecache):
+        if address is None or key[0] == address:
+            del balancecache[key]
+
 def setup_logger(log_file="app.log", log_level=logging.INFO, name=__name__):
 
     # Ensure the directory exists
@@ -54,21 +109,528 @@ def setup_logger(log_file="app.log", log_level=logging.INFO, name=__name__):
     
     return logger
 
-def wrapper(host, api, postData='', headers=''):
+class RateLimiter:
+    """
+    Spaces out calls so that at most rate calls per second are started, across threads.
+    A throttled call pauses all calls and halves the rate, which then recovers by
+    1% of the ceiling per successful call.
+    """
 
-    if postData:
-        req = requests.post('%s%s' % (host, api), data=postData, headers={'content-type': 'application/json'}, timeout=30)
-    else:
-        req = requests.get('%s%s' % (host, api), headers=headers, timeout=30)
-    try:
-        return req.json()
-    except json.JSONDecodeError as e:
-        print(f"> JSON Decode error: {e}")
+    def __init__(self, rate):
+        self.ceiling = rate or 0
+        self.rate = self.ceiling
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + (1.0 / self.rate if self.rate else 0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self, delay):
+        with self.lock:
+            self.next = max(self.next, time.monotonic() + delay)
+            if self.ceiling:
+                self.rate = max(self.ceiling / 16, self.rate / 2)
+
+    def succeeded(self):
+        if self.rate < self.ceiling:
+            with self.lock:
+                self.rate = min(self.ceiling, self.rate + self.ceiling / 100)
+
+ratelimiter = RateLimiter(None)
+
+# Upper bounds in seconds of the node request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def set_rate_limit(rate):
+    """Sets the maximum node requests per second, None or 0 disables the limit."""
+    global ratelimiter
+    ratelimiter = RateLimiter(rate)
+
+class BatchSize:
+    """
+    Number of blocks or ids requested at once from a paged or bulk endpoint. It grows by
+    a quarter while responses are fast and small, shrinks towards targetseconds and
+    maxbytes when they are not, and is halved on errors and throttling.
+    """
+
+    def __init__(self, size, minsize, maxsize, targetseconds=2.0, maxbytes=8 * 1024 * 1024):
+        self.minsize = max(1, minsize)
+        self.maxsize = max(self.minsize, maxsize)
+        self.size = max(self.minsize, min(size, self.maxsize))
+        self.targetseconds = targetseconds
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Restarts the counters, keeping the size."""
+        self.stats = {
+            'requests': 0, 'items': 0, 'bytes': 0, 'errors': 0, 'throttled': 0,
+            'minsize': self.size, 'maxsize': self.size, 'started': None, 'finished': None
+        }
+
+    def record(self, items, elapsed, size, error=False, throttled=False):
+        """Adapts the size to a request of items taking elapsed seconds and size bytes."""
+        with self.lock:
+            stats = self.stats
+            now = time.monotonic()
+            if stats['started'] is None:
+                stats['started'] = now - elapsed
+            stats['finished'] = now
+            # relative to the size of the request, so that concurrent requests do not compound
+            if throttled:
+                stats['throttled'] += 1
+                self.size = max(self.minsize, min(self.size, items // 2))
+            elif error:
+                stats['errors'] += 1
+                self.size = max(self.minsize, min(self.size, items // 2))
+            else:
+                stats['requests'] += 1
+                stats['items'] += items
+                stats['bytes'] += size
+                if elapsed > self.targetseconds or size > self.maxbytes:
+                    factor = min(self.targetseconds / max(elapsed, self.targetseconds), self.maxbytes / max(size, self.maxbytes))
+                    self.size = max(self.minsize, min(self.size, int(items * max(factor, 0.5))))
+                elif elapsed < self.targetseconds / 2 and size < self.maxbytes / 2 and items >= self.size:
+                    self.size = min(self.maxsize, items + max(1, items // 4))
+            stats['minsize'] = min(stats['minsize'], self.size)
+            stats['maxsize'] = max(stats['maxsize'], self.size)
+
+class NodeClient:
+    """
+    Keep-alive HTTP client for a node: pooled connections, gzip, retries with
+    exponential backoff on 5xx/timeouts and per-endpoint latency counters.
+    """
+
+    def __init__(self, host, timeout=30, retries=3, backoff=0.5, poolsize=16):
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # imported here, so that commands that never reach the node do not load requests
+        import requests.adapters
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def request(self, api, postData='', headers='', transform=None, items=None, retries=None):
+        """
+        Returns the decoded JSON response, None if the node could not be reached.
+        With transform, a JSON array is streamed and decoded one element at a time,
+        and the list of transform(element) is returned instead. items is the number
+        of blocks or ids requested, every attempt then adapts batchsize(api).
+        retries overrides the client retries, e.g. 0 for a request that must not be sent twice.
+        """
+        import requests
+        endpoint = endpointname(api)
+        streaming = transform is not None
+        batch = batchsize(api) if items else None
+        for attempt in range((self.retries if retries is None else retries) + 1):
+            if attempt > 0:
+                self.count(endpoint, 'retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            ratelimiter.acquire()
+            started = time.monotonic()
+            try:
+                if postData:
+                    req = self.session.post('%s%s' % (self.host, api), data=postData, headers={'content-type': 'application/json'}, timeout=self.timeout, stream=streaming)
+                else:
+                    req = self.session.get('%s%s' % (self.host, api), headers=headers or None, timeout=self.timeout, stream=streaming)
+                if streaming and req.status_code < 400:
+                    size = [0]
+                    content = decodestream(countchunks(req.iter_content(STREAM_CHUNK_SIZE), size), transform)
+                    size = size[0]
+                else:
+                    size = len(req.content)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                self.count(endpoint, 'errors', time.monotonic() - started)
+                if batch:
+                    batch.record(items, time.monotonic() - started, 0, error=True)
+                print(f"> Request error: {e}")
+                continue
+            except json.JSONDecodeError as e:
+                self.count(endpoint, 'errors', time.monotonic() - started)
+                if batch:
+                    batch.record(items, time.monotonic() - started, 0, error=True)
+                print(f"> JSON Decode error: {e}")
+                return None
+            elapsed = time.monotonic() - started
+            self.count(endpoint, 'requests', elapsed, size)
+            if batch:
+                batch.record(items, elapsed, size, error=req.status_code >= 400, throttled=req.status_code == 429)
+            if req.status_code == 429:
+                self.count(endpoint, 'throttled')
+                ratelimiter.throttle(retryafter(req, self.backoff))
+                print(f"> Request throttled: HTTP 429 from {api}")
+                continue
+            if req.status_code >= 500:
+                self.count(endpoint, 'errors')
+                print(f"> Request error: HTTP {req.status_code} from {api}")
+                continue
+            ratelimiter.succeeded()
+            if streaming and req.status_code < 400:
+                return content
+            try:
+                return jsonloads(req.content)
+            except json.JSONDecodeError as e:
+                print(f"> JSON Decode error: {e}")
+                return None
+            except Exception as e:
+                print(f"> Request error: {e}")
+                return None
         return None
-    except Exception as e:
-        print(f"> Request error: {e}")
+
+    def count(self, endpoint, counter, elapsed=None, size=0):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {
+                'requests': 0, 'errors': 0, 'retries': 0, 'throttled': 0, 'bytes': 0, 'seconds': 0.0, 'maxseconds': 0.0,
+                'buckets': [0] * (len(LATENCY_BUCKETS) + 1)
+            })
+            stats[counter] += 1
+            stats['bytes'] += size
+            if elapsed is not None:
+                stats['seconds'] += elapsed
+                stats['maxseconds'] = max(stats['maxseconds'], elapsed)
+                stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+class NodePool:
+    """
+    Spreads requests over the healthy nodes of hosts. Every healthinterval seconds the
+    heights and block ids of the nodes are checked: a node more than maxheightlag blocks
+    behind the highest one, on another chain than most nodes, or that failed a request,
+    is excluded until the next check. A request slower than hedgepercentile of the recent
+    latencies of its endpoint is sent again to another node and the first answer is used.
+    """
+
+    def __init__(self, hosts, healthinterval=30, maxheightlag=5, hedgepercentile=95, hedgesamples=20):
+        self.hosts = list(hosts)
+        self.healthinterval = healthinterval
+        self.maxheightlag = maxheightlag
+        self.hedgepercentile = hedgepercentile
+        self.hedgesamples = hedgesamples
+        self.lock = threading.Lock()
+        self.checklock = threading.Lock()
+        self.checked = None
+        self.nodes = {host: {'status': 'unchecked', 'height': None, 'inflight': 0, 'requests': 0, 'failures': 0} for host in self.hosts}
+        self.latencies = {}
+        self.hedges = 0
+        self.rerouted = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.hosts) * nodeclientoptions.get('poolsize', 16)) if len(self.hosts) > 1 else None
+
+    def check(self, force=False):
+        """Checks the health of the nodes if the last check is older than healthinterval."""
+        if self.executor is None:
+            return
+        with self.checklock:
+            if not force and self.checked is not None and time.monotonic() - self.checked < self.healthinterval:
+                return
+            heights = dict(zip(self.hosts, self.executor.map(height, self.hosts)))
+            highest = max((value for value in heights.values() if value is not None), default=None)
+            if highest is None:
+                raise Exception(f"None of the nodes {', '.join(self.hosts)} could be reached.")
+            status = {}
+            for host, value in heights.items():
+                if value is None:
+                    status[host] = 'unreachable'
+                elif value < highest - self.maxheightlag:
+                    status[host] = f"{highest - value} blocks behind"
+
+            # compare the block ids below the lowest height, the last block changes with its microblocks
+            fresh = [host for host in self.hosts if host not in status]
+            common = max(1, min(heights[host] for host in fresh) - 1)
+            ids = dict(zip(fresh, self.executor.map(lambda host: self.blockid(host, common), fresh)))
+            # most nodes win, a tie goes to the chain of the first node listed
+            counts = collections.Counter(value for value in ids.values() if value is not None)
+            chain = max(counts, key=counts.get, default=None)
+            for host in fresh:
+                if ids[host] is None:
+                    status[host] = 'unreachable'
+                elif ids[host] != chain:
+                    status[host] = f"on another chain at height {common}"
+
+            with self.lock:
+                for host in self.hosts:
+                    node = self.nodes[host]
+                    if status.get(host, 'healthy') != node['status'] and (host in status or node['status'] != 'unchecked'):
+                        print(f"> Node {host}: {status.get(host, 'healthy')}")
+                    node['status'] = status.get(host, 'healthy')
+                    node['height'] = heights[host]
+            self.checked = time.monotonic()
+
+    def blockid(self, host, blockheight):
+        res = nodeclient(host).request('/blocks/headers/seq/%d/%d' % (blockheight, blockheight))
+        if isinstance(res, list) and res:
+            return res[0].get('id', res[0].get('signature'))
         return None
 
+    def height(self):
+        """The height every healthy node has reached."""
+        if self.executor is None:
+            return height(self.hosts[0])
+        self.check()
+        with self.lock:
+            heights = [node['height'] for node in self.nodes.values() if node['status'] == 'healthy']
+        return min(heights) if heights else None
+
+    def pick(self, tried):
+        """The healthy node not tried yet with the fewest requests in flight, None if there is none."""
+        with self.lock:
+            hosts = [host for host in self.hosts if host not in tried and self.nodes[host]['status'] == 'healthy']
+            return min(hosts, key=lambda host: self.nodes[host]['inflight'], default=None)
+
+    def hedgedelay(self, endpoint):
+        with self.lock:
+            latencies = sorted(self.latencies.get(endpoint, ()))
+        if len(latencies) < self.hedgesamples:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * self.hedgepercentile // 100)]
+
+    def send(self, host, endpoint, args):
+        with self.lock:
+            self.nodes[host]['inflight'] += 1
+        started = time.monotonic()
+        try:
+            res = nodeclient(host).request(*args)
+        finally:
+            with self.lock:
+                self.nodes[host]['inflight'] -= 1
+        with self.lock:
+            if res is None:
+                self.nodes[host]['failures'] += 1
+                if self.nodes[host]['status'] == 'healthy':
+                    self.nodes[host]['status'] = 'failing'
+                    print(f"> Node {host}: failing")
+            else:
+                self.nodes[host]['requests'] += 1
+                self.latencies.setdefault(endpoint, collections.deque(maxlen=200)).append(time.monotonic() - started)
+        return res
+
+    def request(self, api, postData='', headers='', transform=None, items=None):
+        """NodeClient.request on the pool, None if no healthy node answered."""
+        args = (api, postData, headers, transform, items)
+        if self.executor is None:
+            return nodeclient(self.hosts[0]).request(*args)
+        self.check()
+        endpoint = endpointname(api)
+        tried = []
+        pending = {}
+        while True:
+            if not pending:
+                host = self.pick(tried)
+                if host is None:
+                    return None
+                tried.append(host)
+                pending[self.executor.submit(self.send, host, endpoint, args)] = host
+            # the node a hedge would go to, picked once: health can change while waiting
+            candidate = self.pick(tried) if len(pending) == 1 else None
+            done, _ = concurrent.futures.wait(pending, timeout=self.hedgedelay(endpoint) if candidate is not None else None, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                host = pending.pop(future)
+                if future.result() is not None:
+                    if host != tried[0]:
+                        with self.lock:
+                            self.rerouted += 1
+                    return future.result()
+            if not done and candidate is not None:
+                tried.append(candidate)
+                pending[self.executor.submit(self.send, candidate, endpoint, args)] = candidate
+                with self.lock:
+                    self.hedges += 1
+
+def countchunks(chunks, size):
+    for chunk in chunks:
+        size[0] += len(chunk)
+        yield chunk
+
+def decodestream(chunks, transform):
+    """
+    Decodes a JSON document read in byte chunks. Arrays are decoded one element at a time
+    and each element is replaced by transform(element), anything else (e.g. an error
+    object) is decoded whole.
+    """
+
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+    if not head.lstrip().startswith(b'['):
+        return jsonloads(head + b''.join(chunks))
+    return [transform(element) for element in iterarray(itertools.chain([head], chunks))]
+
+def iterarray(chunks):
+    """
+    Yields the elements of a JSON array read in byte chunks. Only the elements not read
+    yet are buffered, so memory does not grow with the array length.
+    """
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    text = ''
+    position = None
+    retry = 0
+    # None marks the end of the stream
+    for chunk in itertools.chain(chunks, [None]):
+        text += decoder.decode(chunk or b'', final=chunk is None)
+        if position is None:
+            position = text.index('[') + 1
+        # an element cut by the chunk boundary is decoded again once the buffer doubled
+        if chunk is not None and len(text) < retry:
+            continue
+        while True:
+            position = JSON_SEPARATORS.match(text, position).end()
+            if text.startswith(']', position):
+                return
+            try:
+                element, end = JSON_DECODER.raw_decode(text, position)
+            except json.JSONDecodeError:
+                end = len(text)
+            # an element reaching the end of the buffer may be a truncated number, and
+            # a number followed by anything but a separator may be the prefix of a longer
+            # one cut by the chunk boundary, e.g. 1 of 1e-07
+            if end >= len(text) or (chunk is not None and isinstance(element, (int, float)) and not JSON_NUMBER_END.match(text, end)):
+                break
+            yield element
+            position = end
+        text = text[position:]
+        position = 0
+        retry = 2 * len(text)
+    raise json.JSONDecodeError("Unterminated JSON array", text, len(text))
+
+def retryafter(req, default):
+    """Seconds to wait from the Retry-After header of a throttled response."""
+    try:
+        return float(req.headers.get('Retry-After', default))
+    except ValueError:
+        return default
+
+def endpointname(api):
+    """Groups API paths by endpoint, e.g. /blocks/seq/1/100 -> /blocks/seq."""
+    return '/' + '/'.join(api.strip('/').split('/')[:2])
+
+nodeclients = {}
+nodeclientoptions = {}
+nodepools = {}
+nodepooloptions = {}
+
+def configure_node_client(config):
+    """
+    Sets the options of the shared node clients from the http section of config, of the
+    node pools from the nodepool section and of the adaptive batch sizes from the batch section.
+    """
+    nodeclientoptions.clear()
+    nodeclientoptions.update(config.get('http', {}))
+    nodeclients.clear()
+    nodepooloptions.clear()
+    nodepooloptions.update(config.get('nodepool', {}))
+    nodepools.clear()
+    batchoptions.clear()
+    batchoptions.update(config.get('batch', {}))
+    batchsizes.clear()
+
+# Batch sizes of the paged and bulk endpoints, the maximums are the default limits of the node REST API
+BATCH_KINDS = {
+    '/blocks/seq': 'blocks',
+    '/blocks/headers': 'blocks',
+    '/transactions/info': 'ids',
+    '/transactions/status': 'ids',
+    '/leasing/info': 'ids'
+}
+DEFAULT_BATCH_SIZES = {
+    'blocks': {'size': 100, 'min': 10, 'max': 100},
+    'ids': {'size': 900, 'min': 50, 'max': 900}
+}
+
+batchsizes = {}
+batchoptions = {}
+batchlock = threading.Lock()
+
+def batchsize(api):
+    """Returns the shared adaptive batch size of the endpoint of api."""
+    endpoint = endpointname(api)
+    with batchlock:
+        if endpoint not in batchsizes:
+            kind = BATCH_KINDS[endpoint]
+            sizes = dict(DEFAULT_BATCH_SIZES[kind], **batchoptions.get(kind, {}))
+            batchsizes[endpoint] = BatchSize(
+                sizes['size'], sizes['min'], sizes['max'],
+                batchoptions.get('targetseconds', 2.0), batchoptions.get('maxbytes', 8 * 1024 * 1024)
+            )
+        return batchsizes[endpoint]
+
+def log_batch_stats(logger):
+    """Logs the batch sizes and throughput of every endpoint since the last call, and restarts the counters."""
+    with batchlock:
+        batches = sorted(batchsizes.items())
+    for endpoint, batch in batches:
+        with batch.lock:
+            stats = batch.stats
+            if stats['started'] is None:
+                continue
+            elapsed = stats['finished'] - stats['started']
+            rate = f"{stats['items'] / elapsed:.1f}" if elapsed > 0 else '-'
+            logger.info(
+                f"Batch {endpoint}: size {batch.size} (min {stats['minsize']}, max {stats['maxsize']}), "
+                f"{stats['requests']} requests, {stats['items']} items, {rate} items/s, "
+                f"{stats['bytes'] / 2 ** 20:.1f}MB, {stats['errors']} errors, {stats['throttled']} throttled"
+            )
+            batch.reset()
+
+def nodeclient(host):
+    """Returns the shared client for host."""
+    if host not in nodeclients:
+        nodeclients[host] = NodeClient(host, **nodeclientoptions)
+    return nodeclients[host]
+
+def nodepool(config):
+    """Returns the shared pool of the waves.nodes of config, of waves.node when there are none."""
+    hosts = tuple(config['waves'].get('nodes') or [config['waves']['node']])
+    if hosts not in nodepools:
+        nodepools[hosts] = NodePool(hosts, **nodepooloptions)
+    return nodepools[hosts]
+
+def nodestats():
+    """Per-endpoint request counters of all the shared clients."""
+    stats = {}
+    for client in list(nodeclients.values()):
+        with client.lock:
+            for endpoint, counters in client.stats.items():
+                if endpoint not in stats:
+                    stats[endpoint] = dict(counters, buckets=list(counters['buckets']))
+                    continue
+                total = stats[endpoint]
+                for counter in ('requests', 'errors', 'retries', 'throttled', 'bytes', 'seconds'):
+                    total[counter] += counters[counter]
+                total['maxseconds'] = max(total['maxseconds'], counters['maxseconds'])
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], counters['buckets'])]
+    return stats
+
+def log_node_stats(logger):
+    for pool in list(nodepools.values()):
+        if pool.executor is None:
+            continue
+        with pool.lock:
+            for host, node in pool.nodes.items():
+                logger.info(f"Node {host}: {node['status']}, height {node['height']}, {node['requests']} requests, {node['failures']} failures")
+            logger.info(f"Hedged {pool.hedges} slow requests, {pool.rerouted} requests answered by another node than the first one tried")
+    for endpoint, stats in sorted(nodestats().items()):
+        average = stats['seconds'] / stats['requests'] if stats['requests'] else 0
+        logger.info(f"Node {endpoint}: {stats['requests']} requests, {stats['errors']} errors, {stats['retries']} retries, {stats['throttled']} throttled, avg {average:.3f}s, max {stats['maxseconds']:.3f}s")
+
+def wrapper(host, api, postData='', headers='', transform=None, items=None):
+    """Requests api from host, a node url or a NodePool, see NodeClient.request."""
+    client = host if isinstance(host, NodePool) else nodeclient(host)
+    return client.request(api, postData, headers, transform, items)
+
 def blockchainrewards(host):
     """Gets blockchain reward"""
     res = wrapper(host, f"/blockchain/rewards")
@@ -83,23 +645,60 @@ def tx(host, tx_id):
         return res
     return None
 
-def tx_bulk(host, tx_ids):
-    """Gets multiple transactions by their IDs in chunks."""
-    if not tx_ids:
+def tx_bulk(host, tx_ids, transform=None):
+    """Gets multiple transactions by their IDs in chunks, see NodeClient.request for transform."""
+    return post_bulk(host, "/transactions/info", tx_ids, transform)
+
+def tx_status_bulk(host, tx_ids):
+    """Gets the confirmation status of multiple transactions by their IDs in chunks."""
+    return post_bulk(host, "/transactions/status", tx_ids)
+
+def lease_info_bulk(host, lease_ids):
+    """Gets the status of multiple leases by their IDs in chunks."""
+    return post_bulk(host, "/leasing/info", lease_ids)
+
+def post_bulk(host, api, ids, transform=None):
+    """Posts ids to a bulk info endpoint in chunks of the adaptive batchsize(api)."""
+    if not ids:
         return []
     all_results = []
-    chunk_size = 900
-    for i in range(0, len(tx_ids), chunk_size):
-        chunk_ids = tx_ids[i:i + chunk_size]
+    batch = batchsize(api)
+    i = 0
+    while i < len(ids):
+        chunk_ids = ids[i:i + batch.size]
         body = json.dumps({"ids": chunk_ids})
-        res = wrapper(host, "/transactions/info", postData=body)        
-        if res is not None:
+        res = wrapper(host, api, postData=body, transform=transform, items=len(chunk_ids))
+        if isinstance(res, list):
             all_results.extend(res)
         else:
-            print(f"Failed to fetch or unexpected response for chunk starting at index {i}: {res}")
-            sys.exit(1)
+            raise Exception(f"Failed to fetch or unexpected response for chunk starting at index {i}: {res}")
+        i += len(chunk_ids)
     return all_results
 
+def active_leases(host, address):
+    """Gets the active leases to an address."""
+    res = wrapper(host, f"/leasing/active/{address}")
+    if isinstance(res, list):
+        return res
+    raise Exception(f"Failed to fetch active leases of {address}: {res}")
+
+def address_transactions(host, address, startheight, limit=1000):
+    """Gets the transactions of an address, newest first, down to startheight."""
+    transactions = []
+    after = None
+    while True:
+        api = f"/transactions/address/{address}/limit/{limit}"
+        if after is not None:
+            api += f"?after={after}"
+        res = wrapper(host, api)
+        if not isinstance(res, list):
+            raise Exception(f"Failed to fetch transactions of {address}: {res}")
+        page = res[0] if res else []
+        transactions.extend(page)
+        if len(page) < limit or page[-1]['height'] < startheight:
+            return transactions
+        after = page[-1]['id']
+
 def encrypt_decrypt(mode, password, encrypted_key):
     """Encrypts/decrypts a key."""
     key = Fernet.generate_key() #generate a key, or load a key from a file.
@@ -123,6 +722,26 @@ def encrypt_decrypt(mode, password, encrypted_key):
         print("Error: Invalid mode for encrypt_decrypt.")
         sys.exit(1)
 
+def connect_db(config, readonly=False):
+    """
+    Opens the database and applies the connection pragmas of the sqlite config section.
+    A read-only connection fails on a missing database instead of creating it.
+    """
+    if readonly:
+        if not os.path.isfile(config['database']):
+            raise Exception(f"Database {config['database']} not found.")
+        conn = sqlite3.connect(pathlib.Path(config['database']).resolve().as_uri() + '?mode=ro', uri=True)
+    else:
+        conn = sqlite3.connect(config['database'])
+    pragmas = config.get('sqlite', {})
+    if 'journal_mode' in pragmas and not readonly:
+        conn.execute(f"PRAGMA journal_mode = {pragmas['journal_mode']}")
+    if 'synchronous' in pragmas:
+        conn.execute(f"PRAGMA synchronous = {pragmas['synchronous']}")
+    if 'cache_size' in pragmas:
+        conn.execute(f"PRAGMA cache_size = {int(pragmas['cache_size'])}")
+    return conn
+
 def load_config_from_file(filepath):
     try:
         with open(filepath, 'r') as f:
@@ -0,0 +1,165 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import libs
+
+class Metrics:
+    """
+    Metrics of a run: stage timers, counters and processed items per stage.
+    Stage seconds are summed over calls and threads, so parallel stages can
+    exceed the run time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.processed = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] += elapsed
+                stage['calls'] += 1
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def process(self, stage, unit, items):
+        with self.lock:
+            self.processed[(stage, unit)] = self.processed.get((stage, unit), 0) + items
+
+    def summary(self, job, success):
+        """Returns the metrics of the run and the node HTTP statistics as a dict."""
+        with self.lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+            processed = []
+            for (stage, unit), items in sorted(self.processed.items()):
+                seconds = stages.get(stage, {}).get('seconds', 0)
+                processed.append({'stage': stage, 'unit': unit, 'items': items, 'rate': items / seconds if seconds > 0 else None})
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+
+        return {
+            'job': job,
+            'success': success,
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'stages': stages,
+            'processed': processed,
+            'counters': counters,
+            'http': libs.nodestats(),
+            'latencybuckets': list(libs.LATENCY_BUCKETS)
+        }
+
+run = Metrics()
+
+def stage(name):
+    """Times the enclosed block as stage name of the current run."""
+    return run.stage(name)
+
+def count(name, value=1, **labels):
+    """Adds value to the counter name, e.g. count('rows_written', 10, table='waves_blocks')."""
+    run.count(name, value, **labels)
+
+def process(stage, unit, items):
+    """Records items (blocks, leases, addresses...) processed by stage, exported with their rate."""
+    run.process(stage, unit, items)
+
+def reset():
+    global run
+    run = Metrics()
+
+def prometheus(summary):
+    """Formats a run summary in the Prometheus text exposition format."""
+
+    job = summary['job']
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f"# HELP l0ps_{name} {help}")
+        lines.append(f"# TYPE l0ps_{name} {kind}")
+        for labels, value in samples:
+            labels = dict({'job': job}, **labels)
+            text = ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+            lines.append(f"l0ps_{name}{{{text}}} {value}")
+
+    metric('run_success', 'gauge', 'Whether the last run completed without errors.', [({}, int(summary['success']))])
+    metric('run_timestamp_seconds', 'gauge', 'Start time of the last run.', [({}, summary['started'])])
+    metric('run_duration_seconds', 'gauge', 'Duration of the last run.', [({}, summary['seconds'])])
+    metric('stage_duration_seconds', 'gauge', 'Time spent in each stage.', [
+        ({'stage': name}, stage['seconds']) for name, stage in sorted(summary['stages'].items())
+    ])
+    metric('stage_calls', 'gauge', 'Number of times each stage ran.', [
+        ({'stage': name}, stage['calls']) for name, stage in sorted(summary['stages'].items())
+    ])
+    # the run counts start from zero on every run and follow poll: they are gauges of the
+    # last run, a counter would read as reset each time
+    metric('processed_last_run', 'gauge', 'Items processed by each stage in the last run.', [
+        ({'stage': item['stage'], 'unit': item['unit']}, item['items']) for item in summary['processed']
+    ])
+    metric('processed_per_second', 'gauge', 'Items processed per second of stage time.', [
+        ({'stage': item['stage'], 'unit': item['unit']}, item['rate']) for item in summary['processed'] if item['rate'] is not None
+    ])
+    names = sorted(set(counter['name'] for counter in summary['counters']))
+    for name in names:
+        metric(f"{name}_last_run", 'gauge', f"{name.replace('_', ' ').capitalize()} in the last run.", [
+            (counter['labels'], counter['value']) for counter in summary['counters'] if counter['name'] == name
+        ])
+
+    http = sorted(summary['http'].items())
+    for counter in ('requests', 'errors', 'retries', 'bytes'):
+        metric(f"http_{counter}_total", 'counter', f"Node HTTP {counter} per endpoint.", [
+            ({'endpoint': endpoint}, stats[counter]) for endpoint, stats in http
+        ])
+
+    lines.append("# HELP l0ps_http_request_duration_seconds Node HTTP request latency per endpoint.")
+    lines.append("# TYPE l0ps_http_request_duration_seconds histogram")
+    for endpoint, stats in http:
+        cumulative = 0
+        for bound, observations in zip(summary['latencybuckets'] + ['+Inf'], stats['buckets']):
+            cumulative += observations
+            lines.append(f'l0ps_http_request_duration_seconds_bucket{{job="{job}",endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+        lines.append(f'l0ps_http_request_duration_seconds_sum{{job="{job}",endpoint="{endpoint}"}} {stats["seconds"]}')
+        lines.append(f'l0ps_http_request_duration_seconds_count{{job="{job}",endpoint="{endpoint}"}} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+def write(config, job, success, logger):
+    """
+    Writes the metrics of the run to <metrics.dir>/l0ps_<job>.prom, for the node exporter
+    textfile collector, and l0ps_<job>.json. An empty metrics.dir disables the export.
+    """
+
+    directory = (config or {}).get('metrics', {}).get('dir', 'metrics')
+    if not directory:
+        return
+
+    summary = run.summary(job, success)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for filename, content in (
+            (f"l0ps_{job}.prom", prometheus(summary)),
+            (f"l0ps_{job}.json", json.dumps(summary, indent=2) + '\n')
+        ):
+            path = os.path.join(directory, filename)
+            # write and rename, so that collectors never read a partial file
+            with open(path + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.error(f"Could not write metrics to {directory}: {e}")
+        return
+
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        logger.info(f"Stage {name}: {stage['seconds']:.2f}s in {stage['calls']} calls")
@@ -0,0 +1,186 @@
+import os
+import sys
+import logging
+import datetime
+import traceback
+import libs
+import leasecoverage
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+INSTALL_SQL = os.path.join(BASEDIR, 'install.sql')
+RELEASES_DIR = os.path.join(BASEDIR, 'releases')
+
+# install.sql already contains the releases up to this version
+INSTALL_VERSION = '0.1.1'
+
+# Hot queries and the access path each of them must use
+HOT_QUERIES = [
+    (
+        "loadblocksinfo",
+        "SELECT * FROM waves_blocks WHERE height >= ? AND height <= ?",
+        (1, 2),
+        "USING INTEGER PRIMARY KEY"
+    ),
+    (
+        "lease cancellation",
+        "UPDATE waves_leases SET end = ?, endleasedate = ? WHERE lease_id = ?",
+        (1, 1, ''),
+        "USING INDEX sqlite_autoindex_waves_leases_1 (lease_id=?)"
+    ),
+    (
+        "calculatepayments lease window",
+        leasecoverage.SQL_LEASES,
+        (1, 2, 3, 4, 5),
+        "USING INDEX idx_waves_leases_address"
+    ),
+    (
+        "calculatepayments lease coverage",
+        leasecoverage.SQL_COVERAGE,
+        (1, 2, 3),
+        "USING INDEX idx_waves_lease_coverage_to"
+    ),
+    (
+        "lease coverage rebuild",
+        "SELECT start, end FROM waves_leases WHERE address = ?",
+        ('',),
+        "USING INDEX idx_waves_leases_address"
+    ),
+    (
+        "sendpayments recipients",
+        "SELECT pd.address, pd.amount, pd.token, pd.token_id, pd.id FROM waves_paymentdetails pd WHERE pd.payment_id = ? AND pd.status = 'new' AND pd.masstransfer_id IS NULL",
+        (1,),
+        "USING INDEX idx_waves_paymentdetails_payment_status"
+    ),
+    (
+        "sendpayments resume",
+        "SELECT mt.id, mt.token, mt.tx, pd.id FROM waves_masstransfers mt JOIN waves_paymentdetails pd ON pd.masstransfer_id = mt.id WHERE mt.payment_id = ? AND mt.status = 'signed' AND pd.status = 'new' ORDER BY mt.rowid, pd.id",
+        (1,),
+        "USING INDEX idx_waves_masstransfers_payment_status"
+    ),
+    (
+        "sendpayments mark paid",
+        "UPDATE waves_paymentdetails SET status = 'paid' WHERE id = ? AND status = 'new'",
+        (1,),
+        "USING INTEGER PRIMARY KEY"
+    ),
+]
+
+def releasekey(release):
+    """'0.1.1' -> (0, 1, 1)"""
+    return tuple(int(part) for part in release.split('.'))
+
+def versionkey(version):
+    """'0.1.1/1' -> ((0, 1, 1), 1)"""
+    release, script = version.split('/')
+    return releasekey(release), int(script)
+
+def releasescripts():
+    """Returns the release script versions found in releases/, in order."""
+    versions = []
+    for release in os.listdir(RELEASES_DIR):
+        releasedir = os.path.join(RELEASES_DIR, release)
+        if not os.path.isdir(releasedir):
+            continue
+        for script in os.listdir(releasedir):
+            if script.endswith('.sql'):
+                versions.append(f"{release}/{script[:-4]}")
+    return sorted(versions, key=versionkey)
+
+def tableexists(conn, table):
+    cursor = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+def appliedversions(conn, logger):
+    """
+    Returns the set of applied versions, creating the tracking table when missing.
+    Databases created before the tracking table existed are detected from their schema.
+    """
+
+    if tableexists(conn, 'schema_migrations'):
+        return set(row[0] for row in conn.execute("SELECT version FROM schema_migrations"))
+
+    conn.execute("CREATE TABLE schema_migrations (version TEXT PRIMARY KEY, timestamp TEXT NOT NULL)")
+    applied = set()
+
+    if not tableexists(conn, 'waves_blocks'):
+        logger.info("Empty database, installing schema.")
+        conn.executescript(open(INSTALL_SQL).read())
+        applied.update(version for version in releasescripts() if versionkey(version)[0] <= releasekey(INSTALL_VERSION))
+    else:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(waves_blocks)")]
+        if 'tx16calls' in columns:
+            applied.update(version for version in releasescripts() if versionkey(version)[0] <= releasekey(INSTALL_VERSION))
+
+    now = datetime.datetime.now().isoformat()
+    conn.executemany("INSERT INTO schema_migrations (version, timestamp) VALUES (?, ?)", [(version, now) for version in applied])
+    conn.commit()
+    return applied
+
+def pendingversions(conn):
+    """Returns the release script versions not applied to the database yet, without changing it."""
+
+    if not tableexists(conn, 'schema_migrations'):
+        return releasescripts()
+    applied = set(row[0] for row in conn.execute("SELECT version FROM schema_migrations"))
+    return [version for version in releasescripts() if version not in applied]
+
+def migrate(conn, logger):
+    """Applies the pending release scripts in order, each one in its own transaction."""
+
+    applied = appliedversions(conn, logger)
+    pending = [version for version in releasescripts() if version not in applied]
+
+    for version in pending:
+        logger.info(f"Applying {version}")
+        sql = open(os.path.join(RELEASES_DIR, version + '.sql')).read()
+        try:
+            conn.executescript(
+                "BEGIN;\n" + sql +
+                f"\nINSERT INTO schema_migrations (version, timestamp) VALUES ('{version}', '{datetime.datetime.now().isoformat()}');\nCOMMIT;"
+            )
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    return pending
+
+def checkqueryplans(conn):
+    """Returns (name, plan, ok) for each hot query, ok is False if it does not use its index."""
+
+    results = []
+    for name, sql, params, expected in HOT_QUERIES:
+        plan = ' | '.join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        results.append((name, plan, expected in plan))
+    return results
+
+def main():
+
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != 'check'):
+        print("Usage: poetry run python migrate.py [check]")
+        sys.exit(1)
+
+    try:
+        logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name="migrate")
+        config = libs.load_config_from_file('config.json')
+        conn = libs.connect_db(config)
+
+        applied = migrate(conn, logger)
+        logger.info(f"Applied {len(applied)} migrations, schema is up to date.")
+
+        if len(sys.argv) == 2:
+            failed = 0
+            for name, plan, ok in checkqueryplans(conn):
+                logger.info(f"{'OK  ' if ok else 'FAIL'} {name}: {plan}")
+                failed += 0 if ok else 1
+            if failed:
+                logger.error(f"{failed} hot queries do not use their index.")
+                sys.exit(1)
+        conn.close()
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_waves_paymentdetails_payment_status ON waves_paymentdetails (payment_id, status, token);
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_waves_leases_end ON waves_leases (end);
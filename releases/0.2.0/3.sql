@@ -0,0 +1,2 @@
+ALTER TABLE waves_blocks ADD COLUMN blockid TEXT;
+ALTER TABLE waves_blocks ADD COLUMN reference TEXT;
@@ -0,0 +1,27 @@
+CREATE INDEX IF NOT EXISTS idx_waves_leases_address ON waves_leases (address);
+
+CREATE TABLE waves_lease_coverage (
+    address TEXT NOT NULL,
+    covered_from INTEGER NOT NULL,
+    covered_to INTEGER,
+    PRIMARY KEY (address, covered_from)
+);
+
+CREATE INDEX idx_waves_lease_coverage_to ON waves_lease_coverage (covered_to);
+
+INSERT INTO waves_lease_coverage (address, covered_from, covered_to)
+WITH leases AS (
+    SELECT rowid AS id, address, start, COALESCE(end, 9223372036854775807) AS end
+    FROM waves_leases
+), ordered AS (
+    SELECT address, start, end, id,
+        MAX(end) OVER (PARTITION BY address ORDER BY start, end, id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS previousend
+    FROM leases
+), segments AS (
+    SELECT address, start, end,
+        SUM(CASE WHEN previousend IS NULL OR start > previousend THEN 1 ELSE 0 END) OVER (PARTITION BY address ORDER BY start, end, id ROWS UNBOUNDED PRECEDING) AS segment
+    FROM ordered
+)
+SELECT address, MIN(start), NULLIF(MAX(end), 9223372036854775807)
+FROM segments
+GROUP BY address, segment;
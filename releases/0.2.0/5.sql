@@ -0,0 +1,7 @@
+CREATE TABLE waves_ledger (
+    height INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    reward INTEGER NOT NULL,
+    share REAL,
+    PRIMARY KEY (height, address)
+);
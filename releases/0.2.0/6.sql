@@ -0,0 +1,15 @@
+CREATE TABLE waves_masstransfers (
+    id TEXT NOT NULL,
+    payment_id INTEGER NOT NULL,
+    token TEXT NOT NULL,
+    tx TEXT NOT NULL,
+    status TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (id)
+);
+
+CREATE INDEX idx_waves_masstransfers_payment_status ON waves_masstransfers (payment_id, status);
+
+ALTER TABLE waves_paymentdetails ADD COLUMN masstransfer_id TEXT;
+
+CREATE INDEX idx_waves_paymentdetails_masstransfer ON waves_paymentdetails (masstransfer_id);
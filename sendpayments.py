@@ -1,15 +1,31 @@
 import sys
 import json
+import math
+import time
 import requests
 import pywaves as pw
 import logging
 import os
 import libs
+import metrics
+import migrate
 import sqlite3
 import decimal
+import traceback
+import hashlib
+import datetime
+import concurrent.futures
 from pprint import pprint
 
-def pay(config, conn, addr, dryrun):
+# Maximum number of transfers of a mass transfer transaction
+MASSTRANSFER_SIZE = 100
+
+# The node rejects a transaction more than 2 hours older than the block before the one
+# it is mined in: a mass transfer the node does not know, older than this before the
+# last block, can no longer be mined and its payments can be signed again
+MASSTRANSFER_MAX_AGE = 3 * 60 * 60 * 1000
+
+def pay(config, conn, addr, dryrun, balances=None):
 
     global logger
 
@@ -36,16 +52,26 @@ def pay(config, conn, addr, dryrun):
             logger.warning(f"No payments to process has been found.")
             sys.exit(1)
 
-        # find recipients for current payment
+        # Mass transfers signed by an earlier run are never signed again while they can
+        # still be mined: they are confirmed, or broadcast again as they were signed
+        if (dryrun=='Y'):
+            inflight, lost = [], []
+        else:
+            with metrics.stage('resume'):
+                inflight, lost = resumechunks(config, conn, currentpaymentid)
+
+        # find recipients for current payment, that are not in a signed mass transfer
         sql = """
             SELECT
                 pd.address,
                 pd.amount,
                 pd.token,
-                pd.token_id
+                pd.token_id,
+                pd.id
             FROM waves_paymentdetails pd
             WHERE pd.payment_id = ?
-            AND pd.status = 'new';
+            AND pd.status = 'new'
+            AND pd.masstransfer_id IS NULL;
             """
 
         cursor = conn.cursor()
@@ -60,24 +86,28 @@ def pay(config, conn, addr, dryrun):
             amount = row[1]
             token = row[2]
             token_id = row[3]
+            detail_id = row[4]
 
             if token not in recipients:
-                 recipients[token] = {'id': None, 'recipients': {}, 'payments': 0, 'total': 0}
+                 recipients[token] = {'id': None, 'recipients': {}, 'detailids': {}, 'payments': 0, 'total': 0}
 
             recipients[token]['token_id'] = token_id
             recipients[token]['total'] += amount
             recipients[token]['payments'] += 1
             recipients[token]['recipients'][address] = amount
+            recipients[token]['detailids'][address] = detail_id
 
             totalpayments += 1
        
         # check if there is enough balance
 
-        balances = libs.get_balances(config, addr)
+        if balances is None:
+            with metrics.stage('balances'):
+                balances = libs.get_balances(config, addr)
         logger.info(f"Total Payments: {totalpayments}")
         logger.info(f"Node Balance: {int(balances['waves']['balance']/(10**8))} $WAVES")
 
-        if balances['waves']['balance'] < recipients['waves']['total']:
+        if 'waves' in recipients and balances['waves']['balance'] < recipients['waves']['total']:
             logger.error(f"Not enough WAVES balance: {balances['waves']['balance']/(10**8):.8f} vs {(recipients['waves']['total'])/(10**8):.8f}")
             return False
         
@@ -90,38 +120,42 @@ def pay(config, conn, addr, dryrun):
                 logger.error(f"Not enough {token} balance: {balances[token]['balance']/(10**balances[token]['decimals']):.8f} vs {details['total']/(10**balances[token]['decimals']):.8f}")
                 return False
 
-        # Pay
+        # Pay: sign every chunk up front, broadcast them and mark rows paid as chunks confirm
 
+        logger.info("--------------------------------------")
         for token, details in recipients.items():
-            currentbatch = [] 
-            logger.info("--------------------------------------")
-            logger.info(f"Paying {token}...")
-            for address, amount in details['recipients'].items():
-                if len(currentbatch)<100:
-                    if amount > 0:
-                        currentbatch.append({ 'recipient': address, 'amount': amount })
-
-            if len(currentbatch) == 100:
-                masspay(config, token, details['token_id'], currentbatch, addr, dryrun)
-                currentbatch = []
-                time.sleep(1)
-
-            if len(currentbatch) > 0:
-                masspay(config, token, details['token_id'], currentbatch, addr, dryrun)
-
-            # Saving data
-
-            logger.info("Updating database...")
-
-            sql = """
-		UPDATE waves_paymentdetails 
-                SET status = 'paid' 
-                WHERE payment_id = ? 
-                AND   status = 'new'
-                AND   token = ?
-            """
-            cursor = conn.cursor()
-            cursor.execute(sql, (currentpaymentid, token))
+            skipped = [details['detailids'][address] for address, amount in details['recipients'].items() if amount <= 0]
+            if skipped:
+                markpaid(conn, skipped)
+
+        with metrics.stage('sign'):
+            chunks = signchunks(addr, recipients)
+        metrics.process('sign', 'payments', sum(len(chunk['transfers']) for chunk in chunks))
+        logger.info(f"Signed {len(chunks)} mass transfers for {sum(len(chunk['transfers']) for chunk in chunks)} payments")
+
+        if (dryrun=='Y'):
+            logger.info("Dryrun mode, not sending tx.")
+            for chunk in chunks:
+                logger.debug(f"{chunk['token']} batch: {chunk['transfers']}")
+                markpaid(conn, chunk['detailids'])
+        else:
+            # the signed chunks are stored before they can be in flight
+            savechunks(conn, currentpaymentid, chunks)
+            conn.commit()
+            with metrics.stage('broadcast'):
+                broadcast(config, chunks + lost)
+            libs.invalidate_balances(addr.address)
+            metrics.process('broadcast', 'transactions', len(chunks) + len(lost))
+            chunks = inflight + chunks
+            with metrics.stage('confirm'):
+                confirm(config, conn, chunks)
+
+            unconfirmed = [chunk for chunk in chunks if not chunk['paid']]
+            if unconfirmed:
+                logger.error(f"{len(unconfirmed)} of {len(chunks)} mass transfers were not confirmed, payment #{currentpaymentid} stays locked.")
+                for chunk in unconfirmed:
+                    logger.error(f"{chunk['token']} mass transfer {chunk['id']} of {len(chunk['transfers'])} payments: {chunk['error']}")
+                return False
 
         # finally, update payment
 
@@ -133,6 +167,7 @@ def pay(config, conn, addr, dryrun):
 
         cursor = conn.cursor() 
         cursor.execute(sql, (currentpaymentid,))
+        metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_payments')
 
         if (dryrun=='Y'):
             conn.rollback()
@@ -146,25 +181,214 @@ def pay(config, conn, addr, dryrun):
 
     return True
 
-def masspay(config, token, token_id, batch, addr, dryrun):
-
-    logger.info('Number of payouts in batch: ' + str(len(batch)))
-    #logger.info('paid from address: ' + addr.address)
-    
-    if token != 'waves':
-        if (dryrun=='Y'):
-            logger.info("Dryrun mode, not sending tx.")
-            logger.debug('batch: ' + str(batch))
-        else:
-            pass
-            tx = addr.massTransferAssets(batch, pw.Asset(token_id))
-    else:
-        if (dryrun=='Y'):
-            logger.info("Dryrun mode, not sending tx.")
-            logger.debug('batch: ' + str(batch))
+def signchunks(addr, recipients):
+    """
+    Splits the recipients of every token in mass transfers of MASSTRANSFER_SIZE transfers
+    and signs them, with the fees pywaves massTransferWaves/massTransferAssets would pay.
+    """
+
+    chunks = []
+    extrafee = addr.script()['extraFee']
+    timestamp = int(time.time() * 1000)
+
+    for token, details in recipients.items():
+        transfers = [{'recipient': address, 'amount': amount} for address, amount in details['recipients'].items() if amount > 0]
+        asset = None if token == 'waves' else pw.Asset(details['token_id'])
+        smartfee = pw.DEFAULT_SMART_FEE if asset is not None and asset.isSmart() else 0
+
+        for i in range(0, len(transfers), MASSTRANSFER_SIZE):
+            batch = transfers[i:i + MASSTRANSFER_SIZE]
+            fee = pw.DEFAULT_BASE_FEE + (math.ceil((len(batch) + 1) / 2 - 0.5)) * pw.DEFAULT_BASE_FEE + smartfee + extrafee
+            # distinct timestamps, so that identical batches still get distinct ids
+            if asset is None:
+                tx = addr.txGenerator.generateMassTransferWaves(batch, addr.publicKey, '', timestamp + len(chunks), fee)
+            else:
+                tx = addr.txGenerator.generateMassTransferAssets(batch, asset, addr.publicKey, '', timestamp + len(chunks), fee)
+            addr.signTx(tx)
+            detailids = [details['detailids'][transfer['recipient']] for transfer in batch]
+            chunks.append({'token': token, 'transfers': batch, 'detailids': detailids, 'tx': tx, 'id': masstransferid(tx, addr.pywaves.CHAIN_ID), 'paid': False, 'error': None})
+
+    return chunks
+
+def masstransferid(tx, chainid):
+    """
+    Returns the id of a signed mass transfer: the blake2b256 hash of the protobuf
+    transaction bytes pywaves signs, so that a chunk is known before it is broadcast.
+    """
+    from waves import transaction_pb2, recipient_pb2, amount_pb2
+
+    masstransfer = transaction_pb2.MassTransferTransactionData()
+    masstransfer.asset_id = pw.b58decode(tx['assetId'])
+    if tx.get('attachment'):
+        attachment = transaction_pb2.Attachment()
+        attachment.string_value = pw.b58decode(tx['attachment'])
+        masstransfer.attachment.CopyFrom(attachment)
+    for transfer in tx['transfers']:
+        recipient = recipient_pb2.Recipient()
+        recipient.public_key_hash = pw.b58decode(transfer['recipient'])[2:22]
+        item = transaction_pb2.MassTransferTransactionData.Transfer()
+        item.recipient.CopyFrom(recipient)
+        item.amount = transfer['amount']
+        masstransfer.transfers.append(item)
+    fee = amount_pb2.Amount()
+    fee.amount = tx['fee']
+    transaction = transaction_pb2.Transaction()
+    transaction.chain_id = ord(chainid)
+    transaction.sender_public_key = pw.b58decode(tx['senderPublicKey'])
+    transaction.fee.CopyFrom(fee)
+    transaction.timestamp = tx['timestamp']
+    transaction.version = tx['version']
+    transaction.mass_transfer.CopyFrom(masstransfer)
+    return pw.b58encode(hashlib.blake2b(transaction.SerializeToString(), digest_size=32).digest())
+
+def savechunks(conn, payment_id, chunks):
+    """
+    Stores the signed transaction of every chunk and links its payment details to it.
+    """
+
+    now = datetime.datetime.now().isoformat()
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO waves_masstransfers (id, payment_id, token, tx, status, timestamp) VALUES (?, ?, ?, ?, 'signed', ?)",
+        [(chunk['id'], payment_id, chunk['token'], json.dumps(chunk['tx']), now) for chunk in chunks]
+    )
+    metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_masstransfers')
+    cursor.executemany(
+        "UPDATE waves_paymentdetails SET masstransfer_id = ? WHERE id = ?",
+        [(chunk['id'], detail_id) for chunk in chunks for detail_id in chunk['detailids']]
+    )
+    metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_paymentdetails')
+
+def resumechunks(config, conn, payment_id):
+    """
+    Loads the signed mass transfers of payment_id stored by an earlier run whose payments
+    are not paid yet, and checks their status. Returns them, with the ones the node does
+    not know and that can still be mined, to broadcast again. The payments of a mass
+    transfer that can no longer be mined are released, to be signed again.
+    """
+
+    chunks = {}
+    for tx_id, token, tx, detail_id in conn.execute("""
+        SELECT mt.id, mt.token, mt.tx, pd.id
+        FROM waves_masstransfers mt
+        JOIN waves_paymentdetails pd ON pd.masstransfer_id = mt.id
+        WHERE mt.payment_id = ?
+        AND mt.status = 'signed'
+        AND pd.status = 'new'
+        ORDER BY mt.rowid, pd.id
+    """, (payment_id,)):
+        if tx_id not in chunks:
+            tx = json.loads(tx)
+            chunks[tx_id] = {'token': token, 'transfers': tx['transfers'], 'detailids': [], 'tx': tx, 'id': tx_id, 'paid': False, 'error': None}
+        chunks[tx_id]['detailids'].append(detail_id)
+
+    if not chunks:
+        return [], []
+    logger.info(f"Resuming {len(chunks)} mass transfers signed by an earlier run")
+
+    node = config['waves']['node']
+    statuses = {status['id']: status.get('status') for status in libs.tx_status_bulk(node, list(chunks))}
+    lastblock = libs.wrapper(node, '/blocks/headers/last')
+    if not isinstance(lastblock, dict) or 'timestamp' not in lastblock:
+        raise Exception(f"Failed to fetch the last block: {lastblock}")
+
+    inflight = []
+    lost = []
+    for chunk in chunks.values():
+        if statuses.get(chunk['id']) != 'not_found':
+            inflight.append(chunk)
+        elif chunk['tx']['timestamp'] < lastblock['timestamp'] - MASSTRANSFER_MAX_AGE:
+            logger.warning(f"{chunk['token']} mass transfer {chunk['id']} was never mined and has expired, its {len(chunk['detailids'])} payments are signed again")
+            release(conn, chunk, 'expired')
         else:
-           pass
-           tx = addr.massTransferWaves(batch)
+            logger.info(f"{chunk['token']} mass transfer {chunk['id']} is unknown to the node, broadcasting it again")
+            inflight.append(chunk)
+            lost.append(chunk)
+    conn.commit()
+    return inflight, lost
+
+def release(conn, chunk, status):
+    """
+    Closes a stored mass transfer that will not pay its payments with status, and unlinks
+    them so that they are signed again.
+    """
+
+    conn.execute("UPDATE waves_masstransfers SET status = ? WHERE id = ?", (status, chunk['id']))
+    conn.execute("UPDATE waves_paymentdetails SET masstransfer_id = NULL WHERE masstransfer_id = ? AND status = 'new'", (chunk['id'],))
+
+def broadcast(config, chunks):
+    """
+    Broadcasts the signed chunks, send.broadcastworkers at a time. A broadcast is sent
+    once: a retry after a timeout could follow an accepted one, confirm polls the id of
+    every chunk anyway.
+    """
+
+    def send(chunk):
+        res = libs.nodeclient(config['waves']['node']).request('/transactions/broadcast', postData=json.dumps(chunk['tx']), retries=0)
+        if not isinstance(res, dict) or 'error' in res:
+            chunk['error'] = f"broadcast failed: {res}"
+        elif res.get('id') != chunk['id']:
+            chunk['error'] = f"broadcast returned id {res.get('id')}, expected {chunk['id']}"
+
+    workers = config.get('send', {}).get('broadcastworkers', 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(send, chunks))
+
+    logger.info(f"Broadcasted {sum(1 for chunk in chunks if chunk['error'] is None)} of {len(chunks)} mass transfers")
+
+def confirm(config, conn, chunks):
+    """
+    Polls the status of all the signed chunks in bulk until they are confirmed or
+    send.confirmtimeout expires, marking the rows of each confirmed chunk paid. Chunks
+    whose broadcast failed are polled too, the node may have accepted them. The rows
+    of a chunk confirmed with a failed application status are released.
+    """
+
+    options = config.get('send', {})
+    interval = options.get('confirminterval', 2)
+    confirmations = options.get('confirmations', 0)
+    deadline = time.monotonic() + options.get('confirmtimeout', 300)
+
+    pending = {chunk['id']: chunk for chunk in chunks}
+    while pending and time.monotonic() < deadline:
+        time.sleep(interval)
+        try:
+            statuses = libs.tx_status_bulk(config['waves']['node'], list(pending))
+        except Exception as e:
+            logger.warning(f"Could not fetch the status of {len(pending)} mass transfers: {e}")
+            continue
+
+        for status in statuses:
+            if status.get('status') != 'confirmed' or status.get('confirmations', 0) < confirmations or status['id'] not in pending:
+                continue
+            chunk = pending.pop(status['id'])
+            if status.get('applicationStatus', 'succeeded') != 'succeeded':
+                chunk['error'] = f"application status {status['applicationStatus']}, its payments are signed again on the next run"
+                release(conn, chunk, 'failed')
+                conn.commit()
+                continue
+            markpaid(conn, chunk['detailids'])
+            conn.execute("UPDATE waves_masstransfers SET status = 'confirmed' WHERE id = ?", (chunk['id'],))
+            conn.commit()
+            chunk['paid'] = True
+            chunk['error'] = None
+            logger.info(f"{chunk['token']} mass transfer {chunk['id']} of {len(chunk['transfers'])} payments confirmed at height {status.get('height')}")
+
+    for chunk in pending.values():
+        notconfirmed = "not confirmed in time, the next run checks it again"
+        chunk['error'] = f"{chunk['error']}, {notconfirmed}" if chunk['error'] else notconfirmed
+
+def markpaid(conn, detailids):
+
+    sql = """
+        UPDATE waves_paymentdetails
+        SET status = 'paid'
+        WHERE id = ?
+        AND   status = 'new'
+    """
+    cursor = conn.cursor()
+    cursor.executemany(sql, [(detail_id,) for detail_id in detailids])
+    metrics.count('rows_written', max(cursor.rowcount, 0), table='waves_paymentdetails')
 
 def main():
 
@@ -174,30 +398,38 @@ def main():
 
     global logger
 
+    config = None
+    rc = False
+
     try:
 
         dryrun = sys.argv[1]
         
         config = libs.load_config_from_file('config.json')
+        libs.configure_node_client(config)
         logger = libs.setup_logger(log_file="l0ps.log", log_level=logging.DEBUG, name="sendpayments")
-        conn = sqlite3.connect(config['database'])
+        conn = libs.connect_db(config)
+        migrate.migrate(conn, logger)
         pw.setNode(config['waves']['node'], config['waves']['chain']);
         addr = pw.address.Address(privateKey=config['waves']['pk'])
         logger.info(f"Operating from address {addr.address}")
 
-        rc = pay(config, conn, addr, dryrun)
+        with metrics.stage('pay'):
+            rc = pay(config, conn, addr, dryrun)
         if (rc):
             if (dryrun=='N'):
                 logger.info("Payment has been succesfully completed.")
             else:
                 logger.info("Dryrun mode, payments not sent.")
         else:
-                logger.info("Some errors occurred while paying, check blockchain and update database accordingly.")
+                logger.info("Some errors occurred while paying, run it again to resume the payment.")
 
     except Exception as e:        
         logger.error(f"Error: {e}")
         logger.error(traceback.format_exc())
         sys.exit(1)
+    finally:
+        metrics.write(config, 'sendpayments', rc, logger)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,292 @@
+import re
+import json
+import random
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Addresses are valid base58, so that mass transfers to them can be signed
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+GENERATOR = '3MGeneratorAddressForBenchmarks11'
+GENERATOR_ALIAS = 'benchmark'
+NODEOWNER = '3MNodeownerBeneficiaryAddress1111'
+OTHERNODE = '3MotherGeneratorAddress111111111'
+
+DEFAULT_PARAMS = {
+    'blocks': 2000,
+    'txsperblock': 5,
+    'leasers': 100,
+    'leasedensity': 0.3,
+    'canceldensity': 0.1,
+    'invokedensity': 0.3,
+    'invokedepth': 2,
+    'ourleaseshare': 0.5,
+    'minedshare': 0.2,
+    'seed': 1
+}
+
+def stubaddress(prefix, i):
+    """Returns a 33 characters address made of prefix and i in base58."""
+    digits = ''
+    while True:
+        i, digit = divmod(i, 58)
+        digits = BASE58[digit] + digits
+        if i == 0:
+            break
+    return prefix + digits.rjust(33 - len(prefix), '1')
+
+def makechain(params):
+    """
+    Generates a synthetic chain: blocks with lease, lease cancel and invoke transactions,
+    invoke state changes nested up to invokedepth levels, and the extended info, lease
+    status and generator history a node would serve for it.
+    """
+
+    params = dict(DEFAULT_PARAMS, **params)
+    r = random.Random(params['seed'])
+    leasers = [stubaddress('3MLeaser', i) for i in range(params['leasers'])]
+    dapps = [stubaddress('3MDapp', i) for i in range(5)]
+
+    blocks = []
+    extended = {}
+    leaseinfo = {}
+    history = []
+    active = []
+    k = 0
+
+    def newlease(lease_id, origin, sender, recipient, amount, height):
+        leaseinfo[lease_id] = {
+            'id': lease_id, 'originTransactionId': origin, 'sender': sender, 'recipient': recipient,
+            'amount': amount, 'height': height, 'status': 'active', 'cancelHeight': None, 'cancelTransactionId': None
+        }
+        active.append(lease_id)
+        return recipient == GENERATOR
+
+    def cancellease(tx_id, height):
+        lease = leaseinfo[active.pop(r.randrange(len(active)))]
+        lease.update(status='canceled', cancelHeight=height, cancelTransactionId=tx_id)
+        return lease
+
+    for height in range(1, params['blocks'] + 1):
+        transactions = []
+        for _ in range(r.randint(0, 2 * params['txsperblock'])):
+            k += 1
+            tx_id = 'Tx%040d' % k
+            timestamp = height * 60000 + k % 60000
+            kind = r.random()
+            ours = False
+
+            if kind < params['leasedensity']:
+                recipient = r.choice([GENERATOR, 'address:' + GENERATOR, 'alias:W:' + GENERATOR_ALIAS]) if r.random() < params['ourleaseshare'] else OTHERNODE
+                sender = r.choice(leasers)
+                amount = r.randint(10 ** 8, 10 ** 12)
+                tx = {'id': tx_id, 'type': 8, 'sender': sender, 'recipient': recipient, 'amount': amount, 'timestamp': timestamp, 'height': height}
+                ours = newlease(tx_id, tx_id, sender, recipient if recipient == OTHERNODE else GENERATOR, amount, height)
+                extended[tx_id] = dict(tx)
+
+            elif kind < params['leasedensity'] + params['canceldensity'] and active:
+                lease = cancellease(tx_id, height)
+                tx = {'id': tx_id, 'type': 9, 'sender': lease['sender'], 'leaseId': lease['id'], 'timestamp': timestamp, 'height': height}
+                extended[tx_id] = dict(tx, lease={'recipient': lease['recipient']})
+                ours = lease['recipient'] == GENERATOR
+
+            elif kind < params['leasedensity'] + params['canceldensity'] + params['invokedensity']:
+                txtype = r.choice([16, 16, 18])
+                sender = r.choice([GENERATOR, r.choice(leasers)])
+                ours = sender == GENERATOR
+                statechanges = {'leases': [], 'leaseCancels': [], 'invokes': []}
+                current = statechanges
+                for depth in range(r.randint(0, params['invokedepth'])):
+                    dapp = r.choice(dapps)
+                    if r.random() < 0.5:
+                        lease_id = 'IL%038d%02d' % (k, depth)
+                        recipient = GENERATOR if r.random() < params['ourleaseshare'] else OTHERNODE
+                        amount = r.randint(10 ** 8, 10 ** 11)
+                        current['leases'].append({'id': lease_id, 'recipient': recipient, 'sender': dapp, 'amount': amount})
+                        ours = newlease(lease_id, tx_id, dapp, recipient, amount, height) or ours
+                    if r.random() < 0.3 and active:
+                        lease = cancellease(tx_id, height)
+                        current['leaseCancels'].append({'id': lease['id']})
+                        ours = ours or lease['recipient'] == GENERATOR
+                    nested = {'leases': [], 'leaseCancels': [], 'invokes': []}
+                    current['invokes'].append({'dApp': dapp, 'stateChanges': nested})
+                    current = nested
+                tx = {'id': tx_id, 'type': txtype, 'sender': sender, 'timestamp': timestamp, 'height': height}
+                if txtype == 16:
+                    extended[tx_id] = dict(tx, stateChanges=statechanges)
+                else:
+                    extended[tx_id] = dict(tx, payload={'stateChanges': statechanges})
+
+            else:
+                tx = {'id': tx_id, 'type': 4, 'sender': r.choice(leasers), 'recipient': r.choice(leasers), 'amount': 1, 'timestamp': timestamp, 'height': height}
+                extended[tx_id] = dict(tx)
+
+            transactions.append(tx)
+            if ours:
+                history.append(tx)
+
+        blocks.append({
+            'height': height,
+            'id': 'Block%038d' % height,
+            'reference': 'Block%038d' % (height - 1),
+            'generator': GENERATOR if r.random() < params['minedshare'] else OTHERNODE,
+            'totalFee': sum(r.choice([100000, 500000]) for tx in transactions),
+            'timestamp': height * 60000,
+            'transactions': transactions
+        })
+
+    history.reverse()
+    return {'blocks': blocks, 'extended': extended, 'leaseinfo': leaseinfo, 'history': history}
+
+def randomleases(count, addresses, blocks, seed):
+    """
+    Generates count leases of addresses over blocks heights, without a chain: short and
+    long leases, open ones, and chains of leases that restart where the previous one
+    ends or overlap it. Returns {address: [(start, end, amount), ...]}.
+    """
+
+    r = random.Random(seed)
+    leasers = [stubaddress('3MLeaser', i) for i in range(addresses)]
+    leases = {}
+    for _ in range(count):
+        address = r.choice(leasers)
+        if address in leases and r.random() < 0.5:
+            start, end, _ = r.choice(leases[address])
+            if end is None:
+                start = r.randint(max(1, start - 1000), start + 1000)
+            else:
+                start = r.choice([end - 1, end, end, end + 1, r.randint(max(1, start), end + 1000)])
+        else:
+            start = r.randint(1, blocks)
+        kind = r.random()
+        if kind < 0.3:
+            end = None
+        elif kind < 0.6:
+            end = start + r.randint(0, 1200)
+        else:
+            end = start + r.randint(900, max(900, 3 * blocks))
+        leases.setdefault(address, []).append((start, end, r.randint(1, 10 ** 12)))
+    return leases
+
+def blockheader(block):
+    header = {key: value for key, value in block.items() if key != 'transactions'}
+    header['transactionCount'] = len(block['transactions'])
+    return header
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+    """Serves the node endpoints used by l0ps from the chain of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.server.requests += 1
+        self.server.bytessent += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.strip('/')
+        query = parse_qs(url.query)
+        chain = self.server.chain
+        height = len(chain['blocks'])
+
+        if path == 'blocks/height':
+            return self.send({'height': height})
+        if path == 'blocks/headers/last':
+            return self.send(blockheader(chain['blocks'][-1]))
+        if path == 'blockchain/rewards':
+            return self.send({'height': height, 'currentReward': 600000000})
+        m = re.match(r'blocks/(headers/)?seq/(\d+)/(\d+)$', path)
+        if m:
+            blocks = chain['blocks'][int(m[2]) - 1:int(m[3])]
+            return self.send([blockheader(block) for block in blocks] if m[1] else blocks)
+        m = re.match(r'transactions/info/(\w+)$', path)
+        if m and m[1] in chain['extended']:
+            return self.send(chain['extended'][m[1]])
+        m = re.match(r'transactions/address/(\w+)/limit/(\d+)$', path)
+        if m:
+            history = chain['history'] if m[1] == GENERATOR else []
+            if 'after' in query:
+                ids = [tx['id'] for tx in history]
+                history = history[ids.index(query['after'][0]) + 1:]
+            return self.send([history[:int(m[2])]])
+        m = re.match(r'leasing/active/(\w+)$', path)
+        if m:
+            return self.send([lease for lease in chain['leaseinfo'].values() if lease['recipient'] == m[1] and lease['status'] == 'active'])
+        m = re.match(r'addresses/balance/(\w+)', path)
+        if m:
+            return self.send({'address': m[1], 'confirmations': 0, 'balance': 10 ** 16})
+        m = re.match(r'assets/balance/(\w+)$', path)
+        if m:
+            return self.send({'address': m[1], 'balances': [{'assetId': asset_id, 'balance': 10 ** 16} for asset_id in query.get('id', [])]})
+        m = re.match(r'assets/balance/(\w+)/(\w+)$', path)
+        if m:
+            return self.send({'address': m[1], 'assetId': m[2], 'balance': 10 ** 16})
+        m = re.match(r'addresses/scriptInfo/(\w+)$', path)
+        if m:
+            return self.send({'address': m[1], 'complexity': 0, 'extraFee': 0})
+        m = re.match(r'alias/by-address/(\w+)$', path)
+        if m:
+            return self.send([])
+        self.send({'error': 404, 'message': 'not found'}, status=404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path.strip('/')
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        chain = self.server.chain
+
+        if path == 'transactions/info':
+            return self.send([chain['extended'][tx_id] for tx_id in body['ids']])
+        if path == 'leasing/info':
+            return self.send([chain['leaseinfo'][lease_id] for lease_id in body['ids']])
+        # broadcasted transactions are confirmed in the next block, or stay unconfirmed
+        # while the server is not mining
+        if path == 'transactions/broadcast':
+            # the id a node gives the mass transfers of sendpayments
+            import pywaves as pw
+            import sendpayments
+            tx_id = sendpayments.masstransferid(body, pw.CHAIN_ID)
+            with self.server.lock:
+                self.server.broadcasts.append(tx_id)
+                self.server.broadcasted.setdefault(tx_id, None)
+            return self.send(dict(body, id=tx_id))
+        if path == 'transactions/status':
+            statuses = []
+            with self.server.lock:
+                for tx_id in body['ids']:
+                    if tx_id not in self.server.broadcasted:
+                        statuses.append({'id': tx_id, 'status': 'not_found'})
+                        continue
+                    if self.server.broadcasted[tx_id] is None and self.server.mining:
+                        self.server.broadcasted[tx_id] = len(chain['blocks']) + 1
+                    if self.server.broadcasted[tx_id] is None:
+                        statuses.append({'id': tx_id, 'status': 'unconfirmed'})
+                    else:
+                        statuses.append({'id': tx_id, 'status': 'confirmed', 'height': self.server.broadcasted[tx_id], 'confirmations': 0, 'applicationStatus': 'succeeded'})
+            return self.send(statuses)
+        self.send({'error': 404, 'message': 'not found'}, status=404)
+
+def serve(chain, port=0):
+    """
+    Starts a stub node serving chain in a background thread, returns the server and its url.
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubNodeHandler)
+    server.chain = chain
+    server.requests = 0
+    server.bytessent = 0
+    server.broadcasted = {}
+    server.broadcasts = []
+    server.mining = True
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
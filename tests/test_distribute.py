@@ -0,0 +1,89 @@
+import random
+import logging
+import pytest
+import libs
+import stubnode
+import calculatepayments
+
+SEEDS = range(40)
+
+AIRDROPS = {
+    'unit0': {'enabled': True, 'assetid': 'Unit0AssetId', 'decimals': 8, 'minamount': 0},
+    'token': {'enabled': True, 'assetid': 'TokenAssetId', 'decimals': 2, 'minamount': 0},
+    'disabled': {'enabled': False, 'assetid': 'DisabledAssetId', 'decimals': 8, 'minamount': 0}
+}
+
+@pytest.fixture(autouse=True)
+def rewards(monkeypatch):
+    calculatepayments.logger = logging.getLogger('test')
+    monkeypatch.setattr(libs, 'blockchainrewards', lambda host: {'height': 1, 'currentReward': 600000000})
+
+def period(seed, blockcount=1500, minedshare=0.3, amountscale=1):
+    """A random payout period: config, blocksinfo, balances and leases over blockcount blocks."""
+    r = random.Random(seed)
+    config = {
+        'waves': {
+            'node': 'http://node',
+            'generatoraddress': stubnode.GENERATOR,
+            'nodeownerbeneficiaryaddress': stubnode.NODEOWNER,
+            'percentagetodistribute': r.choice(['90', '95', '100']),
+            'airdrops': AIRDROPS
+        }
+    }
+    startblock = r.randint(1000, 2000)
+    blocks = {}
+    for height in range(startblock + 1, startblock + blockcount + 1):
+        generator = stubnode.GENERATOR if r.random() < minedshare else stubnode.OTHERNODE
+        blocks[height] = (height, generator, r.choice([0, 100000, 500000, 1700000]), 0, height * 60, 0)
+    blocksinfo = {
+        'startblock': (startblock, stubnode.OTHERNODE, 300000, 0, startblock * 60, 0),
+        'blocks': blocks,
+        'minedblocks': sum(1 for row in blocks.values() if row[1] == stubnode.GENERATOR),
+        'endblock': startblock + blockcount
+    }
+    balances = {'waves': {'balance': 10 ** 16, 'assetid': None, 'decimals': 8}}
+    balances['unit0'] = {'balance': r.randint(0, 10 ** 12), 'assetid': 'Unit0AssetId', 'decimals': 8}
+    balances['token'] = {'balance': r.randint(0, 10 ** 6), 'assetid': 'TokenAssetId', 'decimals': 2}
+    leases = stubnode.randomleases(300, 40, startblock + blockcount, seed)
+    leases = {address: [(start, end, amount * amountscale) for start, end, amount in addressleases] for address, addressleases in leases.items()}
+    return config, blocksinfo, balances, leases
+
+def assertidentical(payments, expected):
+    assert payments == expected
+    assert list(payments) == list(expected)
+    for address, tokens in expected.items():
+        assert list(payments[address]) == list(tokens)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_numpy_matches_distribute(seed):
+    pytest.importorskip('numpy')
+    config, blocksinfo, balances, leases = period(seed)
+    expected = calculatepayments.distribute(config, blocksinfo, balances, leases)
+    assertidentical(calculatepayments.distribute_numpy(config, blocksinfo, balances, leases), expected)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_numpy_falls_back_beyond_float_precision(seed, caplog):
+    pytest.importorskip('numpy')
+    config, blocksinfo, balances, leases = period(seed, amountscale=10 ** 5)
+    expected = calculatepayments.distribute(config, blocksinfo, balances, leases)
+    with caplog.at_level(logging.WARNING):
+        payments = calculatepayments.distribute_numpy(config, blocksinfo, balances, leases)
+    assert 'float64 precision' in caplog.text
+    assertidentical(payments, expected)
+
+@pytest.mark.parametrize('workers', [1, 2, 3, 8])
+@pytest.mark.parametrize('seed', range(6))
+def test_parallel_matches_distribute(seed, workers):
+    # shards of a few mined blocks, whose 1000-block lookback spans several shards
+    config, blocksinfo, balances, leases = period(seed)
+    config['waves']['distributionworkers'] = workers
+    expected = calculatepayments.distribute(config, blocksinfo, balances, leases)
+    assertidentical(calculatepayments.distribute_parallel(config, blocksinfo, balances, leases), expected)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_parallel_with_more_shards_than_mined_blocks(seed):
+    config, blocksinfo, balances, leases = period(seed, blockcount=20)
+    config['waves']['distributionworkers'] = 8
+    assert 0 < blocksinfo['minedblocks'] < 8 * 4
+    expected = calculatepayments.distribute(config, blocksinfo, balances, leases)
+    assertidentical(calculatepayments.distribute_parallel(config, blocksinfo, balances, leases), expected)
@@ -0,0 +1,54 @@
+import random
+import logging
+import sqlite3
+import pytest
+import blocks
+import migrate
+import stubnode
+import leasecoverage
+import calculatepayments
+
+SEEDS = range(40)
+
+def minedheights(seed, blockcount):
+    r = random.Random(seed)
+    return sorted(r.sample(range(1, blockcount + 2000), 150))
+
+def reference(heights, leases):
+    return [(height, calculatepayments.getwavesactiveleasesatblock(height, leases)) for height in heights]
+
+def leasesdb(leases):
+    """An in-memory database holding leases and the coverage segments ingestion would store."""
+    conn = sqlite3.connect(':memory:')
+    migrate.migrate(conn, logging.getLogger('test'))
+    rows = [
+        (f"tx{i}", f"lease{i}", '8', address, start, start, end, end, amount)
+        for i, (address, start, end, amount) in enumerate(leasecoverage.leaserows(leases))
+    ]
+    conn.executemany("INSERT INTO waves_leases (tx_id, lease_id, txtype, address, start, leasedate, endleasedate, end, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    blocks.updatecoverage(conn.cursor(), leases.keys())
+    conn.commit()
+    return conn
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_sweep_matches_fullscan(seed):
+    leases = stubnode.randomleases(400, 30, 5000, seed)
+    heights = minedheights(seed, 5000)
+    sweep = list(leasecoverage.activeleasesatblocks(heights, leasecoverage.leaserows(leases)))
+    assert sweep == reference(heights, leases)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_sweep_with_coverage_matches_fullscan(seed):
+    leases = stubnode.randomleases(400, 30, 5000, seed)
+    heights = minedheights(seed, 5000)
+    conn = leasesdb(leases)
+    startblock, endblock = heights[0], heights[-1]
+    windowleases = leasecoverage.loadleases(conn, startblock, endblock)
+    coverage = leasecoverage.loadcoverage(conn, startblock, endblock)
+    sweep = list(leasecoverage.activeleasesatblocks(heights, leasecoverage.leaserows(windowleases), coverage))
+    assert sweep == reference(heights, leases)
+
+def test_sweep_rejects_unordered_heights():
+    leases = stubnode.randomleases(10, 3, 100, 0)
+    with pytest.raises(ValueError):
+        list(leasecoverage.activeleasesatblocks([5, 3], leasecoverage.leaserows(leases)))
@@ -0,0 +1,58 @@
+import json
+import time
+import random
+import pytest
+import libs
+
+def value(r, depth=0):
+    k = r.random()
+    if k < 0.4 or depth > 2:
+        return r.choice([0, -3, 12, 1e-07, -2.5e+30, 3.25, 1E5, 10 ** 20, True, False, None, 'a"bé中', ''])
+    if k < 0.7:
+        return [value(r, depth + 1) for _ in range(r.randint(0, 3))]
+    return {str(i): value(r, depth + 1) for i in range(r.randint(0, 3))}
+
+def split(r, text):
+    cuts = sorted(r.sample(range(1, len(text)), min(len(text) - 1, r.randint(0, 6))))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+@pytest.mark.parametrize('chunks, expected', [
+    ([b'[1e', b'-07]'], [1e-07]),
+    ([b'[1.', b'5, 2]'], [1.5, 2]),
+    ([b'[12', b'3E', b'+2 ]'], [12300.0]),
+    ([b'[-', b'1]'], [-1]),
+    ([b'["\xc3', b'\xa9"]'], ['é']),
+    ([b'{"error": 1}'], {'error': 1}),
+])
+def test_decodestream_chunk_boundaries(chunks, expected):
+    assert libs.decodestream(iter(chunks), lambda element: element) == expected
+
+def test_decodestream_random_chunkings():
+    r = random.Random(7)
+    for _ in range(2000):
+        document = [value(r) for _ in range(r.randint(0, 8))]
+        text = json.dumps(document, separators=r.choice([(',', ':'), (', ', ': ')])).encode()
+        assert libs.decodestream(iter(split(r, text)), lambda element: element) == json.loads(text)
+
+def test_decodestream_unterminated_array():
+    with pytest.raises(json.JSONDecodeError):
+        libs.decodestream(iter([b'[1, 2', b'3']), lambda element: element)
+
+def test_nodepool_hedges_to_the_node_it_checked():
+    pool = libs.NodePool(['http://a', 'http://b'])
+    sent = []
+    # b turns unhealthy between the hedge decision and the hedge
+    picks = iter(['http://a', 'http://b'])
+    pool.check = lambda force=False: None
+    pool.pick = lambda tried: next(picks, None)
+    pool.hedgedelay = lambda endpoint: 0.01
+
+    def send(host, endpoint, args):
+        sent.append(host)
+        time.sleep(0.2 if host == 'http://a' else 0)
+        return {'host': host}
+
+    pool.send = send
+    assert pool.request('/blocks/height') == {'host': 'http://b'}
+    assert sent == ['http://a', 'http://b']
+    assert pool.hedges == 1
@@ -0,0 +1,25 @@
+import logging
+import sqlite3
+import pytest
+import migrate
+
+logger = logging.getLogger('test')
+
+def installeddb():
+    """A database created by install.sql before migrations were tracked."""
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(open(migrate.INSTALL_SQL).read())
+    return conn
+
+@pytest.mark.parametrize('conn', [sqlite3.connect(':memory:'), installeddb()], ids=['empty', 'untracked'])
+def test_hot_queries_use_their_index(conn):
+    migrate.migrate(conn, logger)
+    failed = [(name, plan) for name, plan, ok in migrate.checkqueryplans(conn) if not ok]
+    assert failed == []
+
+def test_migrate_applies_each_release_once():
+    conn = sqlite3.connect(':memory:')
+    migrate.migrate(conn, logger)
+    assert migrate.migrate(conn, logger) == []
+    applied = set(row[0] for row in conn.execute("SELECT version FROM schema_migrations"))
+    assert applied == set(migrate.releasescripts())
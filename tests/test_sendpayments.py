@@ -0,0 +1,107 @@
+import time
+import logging
+import sqlite3
+import pytest
+import pywaves as pw
+import libs
+import migrate
+import stubnode
+import sendpayments
+
+logger = logging.getLogger('test')
+
+@pytest.fixture
+def node():
+    server, url = stubnode.serve(stubnode.makechain(dict(blocks=10, leasers=5)))
+    pw.setNode(url, 'T')
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+def lockedpayment(url, recipients=250):
+    """A database with a locked payment of recipients WAVES payments, and its config."""
+    config = {
+        'waves': {'chain': 'T', 'node': url, 'airdrops': {}},
+        'http': {'retries': 0},
+        'send': {'broadcastworkers': 2, 'confirminterval': 0.05, 'confirmtimeout': 0.5}
+    }
+    sendpayments.logger = logger
+    libs.configure_node_client(config)
+    conn = sqlite3.connect(':memory:')
+    migrate.migrate(conn, logger)
+    conn.execute("INSERT INTO waves_payments (startblock, endblock, minedblocks, paymentlock, timestamp) VALUES (1, 10, 1, 'Y', '')")
+    conn.executemany(
+        "INSERT INTO waves_paymentdetails (payment_id, address, status, token, token_id, amount) VALUES (1, ?, 'new', 'waves', '', ?)",
+        [(stubnode.stubaddress('3MLeaser', i), 1000 + i) for i in range(recipients)]
+    )
+    conn.commit()
+    return config, conn
+
+def pay(config, conn):
+    return sendpayments.pay(config, conn, pw.Address(seed='l0ps test'), 'N', {'waves': {'balance': 10 ** 16, 'decimals': 8}})
+
+def state(conn):
+    return (
+        conn.execute("SELECT status, COUNT(*) FROM waves_paymentdetails GROUP BY status").fetchall(),
+        conn.execute("SELECT paymentlock FROM waves_payments").fetchone()[0]
+    )
+
+def masstransfers(conn):
+    return dict(conn.execute("SELECT id, status FROM waves_masstransfers"))
+
+def test_pay_sends_every_chunk_once(node):
+    server, url = node
+    config, conn = lockedpayment(url)
+    assert pay(config, conn)
+    assert state(conn) == ([('paid', 250)], 'N')
+    assert sorted(server.broadcasts) == sorted(masstransfers(conn))
+    assert set(masstransfers(conn).values()) == {'confirmed'}
+
+def test_unconfirmed_chunks_are_not_signed_again(node):
+    server, url = node
+    config, conn = lockedpayment(url)
+    server.mining = False
+    assert not pay(config, conn)
+    assert state(conn) == ([('new', 250)], 'Y')
+    signed = masstransfers(conn)
+    assert len(signed) == 3 and set(signed.values()) == {'signed'}
+
+    # the first broadcasts are mined after the timeout
+    server.mining = True
+    assert pay(config, conn)
+    assert state(conn) == ([('paid', 250)], 'N')
+    assert masstransfers(conn) == dict.fromkeys(signed, 'confirmed')
+    assert sorted(server.broadcasts) == sorted(signed)
+
+def test_lost_chunks_are_broadcast_again_as_signed(node):
+    server, url = node
+    config, conn = lockedpayment(url)
+    server.mining = False
+    assert not pay(config, conn)
+    signed = masstransfers(conn)
+
+    # the node dropped them, they can still be mined
+    server.broadcasted.clear()
+    server.mining = True
+    assert pay(config, conn)
+    assert state(conn) == ([('paid', 250)], 'N')
+    assert masstransfers(conn) == dict.fromkeys(signed, 'confirmed')
+    assert sorted(server.broadcasts) == sorted(list(signed) * 2)
+
+def test_expired_chunks_are_signed_again(node):
+    server, url = node
+    config, conn = lockedpayment(url)
+    server.mining = False
+    assert not pay(config, conn)
+    signed = masstransfers(conn)
+
+    # dropped by the node, and too old for the next blocks
+    server.broadcasted.clear()
+    server.chain['blocks'][-1]['timestamp'] = int(time.time() * 1000) + sendpayments.MASSTRANSFER_MAX_AGE + 60000
+    server.mining = True
+    assert pay(config, conn)
+    assert state(conn) == ([('paid', 250)], 'N')
+    resigned = masstransfers(conn)
+    assert {tx_id: resigned.pop(tx_id) for tx_id in signed} == dict.fromkeys(signed, 'expired')
+    assert len(resigned) == 3 and set(resigned.values()) == {'confirmed'}
+    assert sorted(server.broadcasts) == sorted(list(signed) + list(resigned))